@@ -1,5 +1,6 @@
 import os, os.path, time, fcntl
 import sqlite3, pickle, threading
+import multiprocessing, tempfile, shutil
 from collections import deque, namedtuple
 
 class Error(RuntimeError):
@@ -125,6 +126,13 @@ class _Metadata:
 			logs.append(row)
 		return logs
 	
+	def get_range_logs(self, queue_name, partitions, start=None, end=None):
+		c = self.meta.cursor()
+		c.execute('SELECT log_file, partition, timestamp FROM queue_logs'
+		          ' WHERE queue=? AND timestamp>=? AND timestamp<?'
+		          ' ORDER BY timestamp, partition', (queue_name, start or 0, end or 2**62))
+		return [row for row in c if row[1] in partitions]
+	
 	def get_last_log(self, queue_name, partition):
 		c = self.meta.cursor()
 		c.execute('SELECT log_file, timestamp FROM queue_logs'
@@ -159,11 +167,19 @@ class _Metadata:
 	
 	def commit(self):
 		self.meta.commit()
+	
+	def close(self):
+		self.meta.close()
+
+def open_metadata(path):
+	# uncached metadata with a connection of its own, for Producer/Consumer(metadata=...) used by one
+	# thread, sqlite connections from get_metadata() are shared by the whole process
+	return _Metadata(path)
 
 
 class Producer:
 	def __init__(self, queue_name, path='.', **kws):
-		self.__metadata = _Metadata.get_metadata(path)
+		self.__metadata = kws.get('metadata') or _Metadata.get_metadata(path)
 		with self.__metadata.lock:
 			self.queue = self.__metadata.create_queue(queue_name, **kws)
 		partitions = self.queue['partitions']
@@ -240,7 +256,7 @@ class Consumer:
 	Message = namedtuple('ConsumeMessage', ['queue', 'partition', 'key', 'payload', 'timestamp', 'next'])
 	
 	def __init__(self, queue_name, group_id, partition=0, path='.', **kws):
-		self.__metadata = _Metadata.get_metadata(path)
+		self.__metadata = kws.get('metadata') or _Metadata.get_metadata(path)
 		self.queue = self.__metadata.get_queue(queue_name)
 		if not self.queue:
 			raise Error("Queue '%s' not found"%queue_name)
@@ -433,6 +449,89 @@ class MultipleConsumer:
 			pconsumer.commit()
 
 
+def _export_segment(args):
+	# filter one segment into the same filename under output, records never pile up in memory
+	path, filename, start, end, keys, output = args
+	n_records, n_bytes = 0, 0
+	try:
+		fd = open('%s/%s'%(path, filename), 'rb')
+	except FileNotFoundError:
+		return filename, n_records, n_bytes
+	with fd, open('%s/%s'%(output, filename), 'wb') as fd_out:
+		while True:
+			try:
+				record = pickle.load(fd)
+			except EOFError:
+				break
+			timestamp, key, message = record
+			if (start and timestamp < start) or (end and timestamp >= end):
+				continue
+			if keys is not None and key not in keys:
+				continue
+			pickle.dump(record, fd_out)
+			n_records += 1
+		n_bytes = fd.tell()
+	return filename, n_records, n_bytes
+
+def export(queue_name, path='.', start=None, end=None, partitions=None, **kws):
+	# replay segments in parallel, never registers a consumer group or moves committed offsets
+	# output: directory receiving one file per segment, and/or callback(message) called in segment order.
+	# The callback is fed one record at a time from the filtered segment files (kept in a temporary
+	# directory without output), so memory does not grow with the segment size.
+	metadata = _Metadata.get_metadata(path)
+	queue = metadata.get_queue(queue_name)
+	if not queue:
+		raise Error("Queue '%s' not found"%queue_name)
+	n = queue['partitions']
+	if partitions is None:
+		partitions = set(range(n))
+	elif not set(partitions).issubset(range(n)):
+		raise Error("Out of range of partitions")
+	
+	output, callback = kws.get('output'), kws.get('callback')
+	if not (output or callable(callback)):
+		raise Error("Either output or callback is required")
+	if callback is not None and not callable(callback):
+		raise Error("callback is not callable")
+	if output and not os.path.exists(output):
+		os.makedirs(output)
+	keys = kws.get('keys')
+	if keys is not None:
+		keys = set(keys)
+	
+	interval = queue['m_interval']*60
+	log_start = int(start)//interval*interval if start else None
+	logs = metadata.get_range_logs(queue_name, set(partitions), log_start, end)
+	partition_of = {filename: partition for filename, partition, _ in logs}
+	
+	q_path = '%s/%s'%(path, queue_name)
+	spool = output or tempfile.mkdtemp(prefix='fmq-export-')
+	tasks = [(q_path, filename, start, end, keys, spool) for filename, _, _ in logs]
+	stats = dict(segments=0, records=0, bytes=0)
+	begin = time.time()
+	try:
+		with multiprocessing.Pool(kws.get('processes')) as pool:
+			for filename, n_records, n_bytes in pool.imap(_export_segment, tasks, kws.get('chunksize', 1)):
+				stats['segments'] += 1
+				stats['records'] += n_records
+				stats['bytes'] += n_bytes
+				if callback is None or not n_records:
+					continue
+				with open('%s/%s'%(spool, filename), 'rb') as fd:
+					for _ in range(n_records):
+						timestamp, key, message = pickle.load(fd)
+						callback(Consumer.Message(queue=queue_name, partition=partition_of[filename],
+						                          key=key, payload=message, timestamp=timestamp, next=None))
+				if not output:
+					os.remove('%s/%s'%(spool, filename))
+	finally:
+		if not output:
+			shutil.rmtree(spool, ignore_errors=True)
+	stats['elapsed'] = time.time() - begin
+	stats['records_per_sec'] = stats['records'] / stats['elapsed'] if stats['elapsed'] else 0.0
+	stats['bytes_per_sec'] = stats['bytes'] / stats['elapsed'] if stats['elapsed'] else 0.0
+	return stats
+
 #########################################################################################################
 
 if __name__ == "__main__":
@@ -1,9 +1,12 @@
-import ctypes, ctypes.util, os, re
+import ctypes, os, re, errno
 
 def clib(name):
+	# ctypes.util pulls in subprocess and shutil, import it only when a library has to be searched
+	import ctypes.util
 	return ctypes.CDLL(ctypes.util.find_library(name))
 
-libc = clib('c')
+# the C library is already loaded into the interpreter, dlopen(NULL) finds its symbols without a search
+libc = ctypes.CDLL(None) if os.name == 'posix' else clib('c')
 
 def _errcheck(result, func, args):
 	if result == -1:
@@ -32,11 +35,72 @@ def cfunc(name, restype, *args, **kws):
 	if isinstance(restype, str):
 		restype = parse_type(restype)
 	prototype = ctypes.CFUNCTYPE(restype, *argtypes, use_errno=True)
-	func = prototype((name, dll), tuple(paramflags))
+	if kws.get('fast'):
+		# plain argtypes: positional arguments only, no defaults, and no paramflags mapping per call;
+		# errcheck=None additionally leaves checking the result to the caller
+		func = prototype((name, dll))
+	else:
+		func = prototype((name, dll), tuple(paramflags))
 	if callable(errcheck):
 		func.errcheck = errcheck
 	return func
 
+def _convert(argtype, value):
+	if isinstance(argtype, type) and issubclass(argtype, ctypes._SimpleCData) and not isinstance(value, argtype):
+		return argtype(value)
+	return value
+
+class Batch:
+	# many calls of one cfunc from rows of arguments converted to ctypes objects up front,
+	# rows can be updated in place through set() between runs
+	def __init__(self, func, rows):
+		self.func = func
+		self.argtypes = func.argtypes or ()
+		self.rows = [self.__row(row) for row in rows]
+	
+	def __row(self, row):
+		return [_convert(argtype, value) for argtype, value in zip(self.argtypes, row)] + list(row[len(self.argtypes):])
+	
+	def __len__(self):
+		return len(self.rows)
+	
+	def set(self, index, row):
+		self.rows[index] = self.__row(row)
+	
+	def __call__(self):
+		# an errcheck of the function raises at the first failing row, without one raw results are returned
+		func = self.func
+		return [func(*row) for row in self.rows]
+
+def batch(func, rows):
+	if isinstance(func, LazyFunc):
+		func = func.bind()
+	return Batch(func, rows)
+
+class LazyFunc:
+	# cfunc() resolved on first call, which then replaces this object in `namespace`
+	# so later calls through the module global go straight to the ctypes function
+	def __init__(self, namespace, name, restype, *args, **kws):
+		self.namespace, self.name = namespace, name
+		self.spec, self.func = (restype, args, kws), None
+	
+	def bind(self):
+		if self.func is None:
+			restype, args, kws = self.spec
+			try:
+				self.func = cfunc(self.name, restype, *args, **kws)
+			except AttributeError:
+				raise OSError(errno.ENOSYS, '%s is not available'%self.name)
+			if self.namespace.get(self.name) is self:
+				self.namespace[self.name] = self.func
+		return self.func
+	
+	def __call__(self, *args, **kws):
+		return (self.func or self.bind())(*args, **kws)
+
+def lazy(namespace, name, restype, *args, **kws):
+	return LazyFunc(namespace, name, restype, *args, **kws)
+
 ctype = {
 	"bool": ctypes.c_bool,
 	"char": ctypes.c_char,
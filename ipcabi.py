@@ -0,0 +1,149 @@
+import os, sys
+
+# Constants and struct layouts of the SysV IPC headers, in the format written by dump_ipchdr.c.
+# Known ABIs are built in, others are probed once by compiling dump_ipchdr.c and cached per platform.
+
+_LINUX_DEFINE = {
+	'IPC_PRIVATE': 0x0000,
+	'IPC_CREAT': 0x0200,
+	'IPC_EXCL': 0x0400,
+	'IPC_NOWAIT': 0x0800,
+	'SHM_RDONLY': 0x1000,
+	'SEM_UNDO': 0x1000,
+	'IPC_RMID': 0x0000,
+	'IPC_STAT': 0x0002,
+	'GETVAL': 0x000c,
+	'GETALL': 0x000d,
+	'SETVAL': 0x0010,
+	'SETALL': 0x0011,
+}
+
+# glibc and musl on x86_64 agree on the offsets of every field svipc reads
+_LINUX_X86_64_STRUCT = {
+	'ipc_perm': {
+		'size': 48,
+		'fields': [
+			('key', 0, 4),
+			('uid', 4, 4),
+			('gid', 8, 4),
+			('cuid', 12, 4),
+			('cgid', 16, 4),
+			('mode', 20, 4),
+			('seq', 24, 2),
+		]},
+	'msqid_ds': {
+		'size': 120,
+		'fields': [
+			('msg_stime', 48, 8),
+			('msg_rtime', 56, 8),
+			('msg_ctime', 64, 8),
+			('msg_cbytes', 72, 8),
+			('msg_qnum', 80, 8),
+			('msg_qbytes', 88, 8),
+			('msg_lspid', 96, 4),
+			('msg_lrpid', 100, 4),
+		]},
+	'shmid_ds': {
+		'size': 112,
+		'fields': [
+			('shm_segsz', 48, 8),
+			('shm_atime', 56, 8),
+			('shm_dtime', 64, 8),
+			('shm_ctime', 72, 8),
+			('shm_cpid', 80, 4),
+			('shm_lpid', 84, 4),
+			('shm_nattch', 88, 8),
+		]},
+	'semid_ds': {
+		'size': 104,
+		'fields': [
+			('sem_otime', 48, 8),
+			('sem_ctime', 64, 8),
+			('sem_nsems', 80, 8),
+		]},
+}
+
+BUILTIN = {
+	('Linux', 'x86_64'): (_LINUX_DEFINE, _LINUX_X86_64_STRUCT),
+}
+
+def libc_version():
+	try:
+		return os.confstr('CS_GNU_LIBC_VERSION').replace(' ', '-')
+	except (ValueError, OSError, AttributeError):
+		return 'libc'
+
+def platform_key():
+	uname = os.uname()
+	return (uname.sysname, uname.machine, libc_version())
+
+def cache_path():
+	directory = os.environ.get('SVIPC_CACHE') or \
+		os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'svipc')
+	return os.path.join(directory, 'ipchdr-%s.py'%'-'.join(platform_key()))
+
+def _read(path):
+	namespace = {}
+	with open(path) as f:
+		exec(compile(f.read(), path, 'exec'), namespace)
+	return namespace['ipc_define'], namespace['ipc_struct']
+
+def probe(source=None, cc=None):
+	# compile and run dump_ipchdr.c, glibc hides ipc_perm.key/seq as __key/__seq so retry with defines
+	import subprocess, tempfile, shutil
+	source = source or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dump_ipchdr.c')
+	cc = cc or os.environ.get('CC', 'cc')
+	workdir = tempfile.mkdtemp(prefix='svipc-')
+	try:
+		binary = os.path.join(workdir, 'dump_ipchdr')
+		for defines in ([], ['-Dkey=__key', '-Dseq=__seq']):
+			if subprocess.run([cc, '-o', binary, source] + defines, capture_output=True).returncode == 0:
+				break
+		else:
+			raise ImportError("Can not compile '%s', set CC or generate ipchdr.py by hand"%source)
+		subprocess.run([binary], cwd=workdir, check=True)
+		return os.path.join(workdir, 'ipchdr.py'), workdir
+	except BaseException:
+		shutil.rmtree(workdir, ignore_errors=True)
+		raise
+
+def load():
+	# built-in table, then the per-platform cache, then a probe that fills the cache
+	uname = os.uname()
+	builtin = BUILTIN.get((uname.sysname, uname.machine))
+	if builtin is not None:
+		return builtin
+	path = cache_path()
+	try:
+		return _read(path)
+	except (OSError, KeyError, SyntaxError):
+		pass
+	import shutil
+	generated, workdir = probe()
+	try:
+		result = _read(generated)
+		try:
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			temp = '%s.%d'%(path, os.getpid())
+			shutil.copyfile(generated, temp)
+			os.replace(temp, path)
+		except OSError as e:
+			print('svipc: can not cache %s: %s'%(path, e), file=sys.stderr)
+		return result
+	finally:
+		shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+	import shutil
+	# python ipcabi.py [--probe]: show where the layout comes from, --probe refreshes the cache
+	if '--probe' in sys.argv:
+		generated, workdir = probe()
+		os.makedirs(os.path.dirname(cache_path()), exist_ok=True)
+		shutil.copyfile(generated, cache_path())
+		shutil.rmtree(workdir, ignore_errors=True)
+		print('cached', cache_path())
+	else:
+		uname = os.uname()
+		print('platform', platform_key())
+		print('builtin' if (uname.sysname, uname.machine) in BUILTIN else 'cache %s'%cache_path())
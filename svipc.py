@@ -1,11 +1,14 @@
-import capi, ctypes, errno
+import capi, ctypes, errno, struct, threading, hashlib, pickle, contextlib
+import os, sys, time, bisect, weakref
 try:
+	# a hand-generated ipchdr.py (compile and run 'dump_ipchdr.c') overrides the built-in layouts
 	from ipchdr import *
 except ImportError:
-	raise ImportError("Please compile 'dump_ipchdr.c' and run")
+	import ipcabi
+	ipc_define, ipc_struct = ipcabi.load()
 
-ftok = capi.cfunc('ftok', 'int', ('path', 'char*'), ('id', 'int'))
-getpagesize = capi.cfunc('getpagesize', 'int')
+ftok = capi.lazy(globals(), 'ftok', 'int', ('path', 'char*'), ('id', 'int'))
+getpagesize = capi.lazy(globals(), 'getpagesize', 'int')
 
 IPC_PRIVATE = ipc_define['IPC_PRIVATE']
 
@@ -62,13 +65,13 @@ class semid_ds(ctypes.Structure):
 
 ############################################### Message Queue ###############################################
 
-msgget = capi.cfunc('msgget', 'int', \
+msgget = capi.lazy(globals(), 'msgget', 'int', \
          ('key', 'int'), ('msgflg', 'int'))
-msgsnd = capi.cfunc('msgsnd', 'int', \
-         ('msqid', 'int'), ('msgp', 'void*'), ('msgsz', 'size_t'), ('msgflg', 'int'))
-msgrcv = capi.cfunc('msgrcv', 'ssize_t', \
-         ('msqid', 'int'), ('msgp', 'void*'), ('msgsz', 'size_t'), ('msgtyp', 'long'), ('msgflg', 'int'))
-msgctl = capi.cfunc('msgctl', 'int', \
+msgsnd = capi.lazy(globals(), 'msgsnd', 'int', \
+         ('msqid', 'int'), ('msgp', 'void*'), ('msgsz', 'size_t'), ('msgflg', 'int'), fast=True)
+msgrcv = capi.lazy(globals(), 'msgrcv', 'ssize_t', \
+         ('msqid', 'int'), ('msgp', 'void*'), ('msgsz', 'size_t'), ('msgtyp', 'long'), ('msgflg', 'int'), fast=True)
+msgctl = capi.lazy(globals(), 'msgctl', 'int', \
          ('msqid', 'int'), ('cmd', 'int'), ('msqid_ds', 'void*', None))
 
 def remove_message_queue(id):
@@ -87,7 +90,18 @@ class MessageQueue:
 		
 		class msgbuf(ctypes.Structure):
 			_fields_ = [('type', ctypes.c_long), ('mtext', ctypes.c_ubyte * max_message_size)]
-		self.__msgbuf = msgbuf()
+		self.__msgbuf_type = msgbuf
+		self.__max_message_size = max_message_size
+		self.__local = threading.local()
+	
+	@property
+	def __msgbuf(self):
+		# one message buffer per thread, so an instance can be shared by threads
+		try:
+			return self.__local.msgbuf
+		except AttributeError:
+			self.__local.msgbuf = self.__msgbuf_type()
+			return self.__local.msgbuf
 	
 	@property
 	def id(self):
@@ -103,24 +117,72 @@ class MessageQueue:
 	def send(self, message, block=True, type=1):
 		if isinstance(message, str) and bytes is not str:
 			message = message.encode()
-		elif not isinstance(message, bytes):
+		try:
+			message = memoryview(message).cast('B')
+		except TypeError:
 			raise TypeError('message must be bytes')
-		if len(message) > len(self.__msgbuf.mtext):
+		if len(message) > self.__max_message_size:
 			raise OSError(errno.E2BIG, 'The message text length is greater than max_message_size')
-		self.__msgbuf.type = type
-		ctypes.memmove(self.__msgbuf.mtext, message, len(message))
-		msgsnd(self.id, ctypes.byref(self.__msgbuf), len(message), 0 if block else IPC_NOWAIT)
+		msgbuf = self.__msgbuf
+		msgbuf.type = type
+		memoryview(msgbuf.mtext).cast('B')[:len(message)] = message
+		msgsnd(self.id, ctypes.byref(msgbuf), len(message), 0 if block else IPC_NOWAIT)
+	
+	def send_many(self, messages, block=True, type=1):
+		# returns the number of messages sent, a full queue stops a non-blocking send
+		n = 0
+		try:
+			for message in messages:
+				self.send(message, block, type)
+				n += 1
+		except BlockingIOError:
+			if block: raise
+		return n
+	
+	def __receive(self, block, type):
+		msgbuf = self.__msgbuf
+		try:
+			msglen = msgrcv(self.id, ctypes.byref(msgbuf), self.__max_message_size, type, 0 if block else IPC_NOWAIT)
+			return msgbuf, msglen
+		except OSError as e:
+			if e.errno == errno.ENOMSG:
+				return msgbuf, -1
+			raise
 	
 	def receive(self, block=True, type=0):
+		msgbuf, msglen = self.__receive(block, type)
+		if msglen < 0:
+			return None
+		return ctypes.string_at(msgbuf.mtext, msglen), msgbuf.type
+	
+	def receive_into(self, buffer, block=True, type=0):
+		# the kernel writes the long type and the text straight into buffer, the text is then moved to the
+		# front in place: no allocation and no msgbuf. Messages longer than len(buffer) - sizeof(long)
+		# fail with E2BIG and stay queued. Returns (length, type) or None
+		dest = memoryview(buffer).cast('B')
+		header = ctypes.sizeof(ctypes.c_long)
+		if len(dest) <= header:
+			raise ValueError('buffer must be larger than %d bytes'%header)
+		raw = (ctypes.c_ubyte * len(dest)).from_buffer(dest)
 		try:
-			msglen = msgrcv(self.id, ctypes.pointer(self.__msgbuf), len(self.__msgbuf.mtext), type, 0 if block else IPC_NOWAIT)
-			message = b'\0' * msglen
-			ctypes.memmove(message, self.__msgbuf.mtext, msglen)
-			return message, self.__msgbuf.type
+			msglen = msgrcv(self.id, raw, min(len(dest) - header, self.__max_message_size), type, 0 if block else IPC_NOWAIT)
 		except OSError as e:
 			if e.errno == errno.ENOMSG:
 				return None
 			raise
+		mtype = ctypes.c_long.from_buffer(dest).value
+		ctypes.memmove(raw, ctypes.byref(raw, header), msglen)
+		return msglen, mtype
+	
+	def receive_many(self, max_count=64, block=True, type=0):
+		# waits for the first message only if block, then drains up to max_count with IPC_NOWAIT
+		messages = []
+		while len(messages) < max_count:
+			message = self.receive(block and not messages, type)
+			if message is None:
+				break
+			messages.append(message)
+		return messages
 	
 	def remove(self):
 		msgctl(self.id, IPC_RMID)
@@ -132,10 +194,10 @@ class MessageQueue:
 
 ############################################### Shared Memory ###############################################
 
-shmget = capi.cfunc('shmget', 'int', ('key', 'int'), ('size', 'size_t'), ('shmflg', 'int'))
-shmctl = capi.cfunc('shmctl', 'int', ('shmid', 'int'), ('cmd', 'int'), ('shmid_ds', 'void*', None))
-shmat  = capi.cfunc('shmat', 'void*',  ('shmid', 'int'), ('shmaddr', 'void*', None), ('shmflg', 'int', 0))
-shmdt  = capi.cfunc('shmdt', 'int', ('shmaddr', 'void*'))
+shmget = capi.lazy(globals(), 'shmget', 'int', ('key', 'int'), ('size', 'size_t'), ('shmflg', 'int'))
+shmctl = capi.lazy(globals(), 'shmctl', 'int', ('shmid', 'int'), ('cmd', 'int'), ('shmid_ds', 'void*', None))
+shmat  = capi.lazy(globals(), 'shmat', 'void*',  ('shmid', 'int'), ('shmaddr', 'void*', None), ('shmflg', 'int', 0))
+shmdt  = capi.lazy(globals(), 'shmdt', 'int', ('shmaddr', 'void*'))
 
 def attach(id, readonly=False):
 	shm = SharedMemory(id, not_key=True)
@@ -159,7 +221,7 @@ class SharedMemory:
 			self.__key = key
 			self.__stbuf = shmid_ds()
 			self.__size = self.stat.shm_segsz
-		self.__address = None
+		self.__address, self.__buffer, self.__readonly = None, None, False
 	
 	@property
 	def id(self):
@@ -175,28 +237,58 @@ class SharedMemory:
 	def attach(self, readonly=False):
 		if self.__address is None:
 			self.__address = shmat(self.id, None, SHM_RDONLY if readonly else 0)
+			self.__readonly = readonly
+			self.__buffer = (ctypes.c_ubyte * self.__size).from_address(self.__address)
 	
 	def detach(self):
 		if self.__address is not None:
+			# every view from as_buffer()/view() holds the ctypes array, unmapping under one would crash
+			if sys.getrefcount(self.__buffer) > 2:
+				raise BufferError('cannot detach shared memory while views of it exist')
+			self.__buffer = None
 			shmdt(self.__address)
 			self.__address = None
 	
+	@property
+	def address(self):
+		return self.__address
+	
+	def as_buffer(self):
+		if self.__address is None:
+			raise ValueError('shared memory is not attached')
+		buf = memoryview(self.__buffer).cast('B')
+		return buf.toreadonly() if self.__readonly else buf
+	
+	def __buffer__(self, flags):
+		return self.as_buffer()
+	
+	def view(self, offset=0, size=None):
+		if not (0 <= offset <= self.__size):
+			raise IndexError('offset out of range')
+		end = self.__size if size is None else min(offset + size, self.__size)
+		return self.as_buffer()[offset:end]
+	
 	def read(self, byte_count, offset=0):
 		if not (0 <= offset < self.__size):
 			raise IndexError('offset out of range')
-		ptr = ctypes.cast(self.__address + offset, ctypes.POINTER(ctypes.c_ubyte))
-		n = min(byte_count, self.__size - offset)
-		buf = b'\0' * n
-		ctypes.memmove(buf, ptr, n)
-		return buf
+		return bytes(self.view(offset, byte_count))
+	
+	def readinto(self, buffer, offset=0):
+		if not (0 <= offset < self.__size):
+			raise IndexError('offset out of range')
+		dest = memoryview(buffer).cast('B')
+		n = min(len(dest), self.__size - offset)
+		dest[:n] = self.view(offset, n)
+		return n
 	
 	def write(self, some_bytes, offset=0):
-		if not isinstance(some_bytes, bytes):
-			raise TypeError('write buffer must be bytes')
-		if not (0 <= offset <= self.__size - len(some_bytes)):
+		try:
+			src = memoryview(some_bytes).cast('B')
+		except TypeError:
+			raise TypeError('write buffer must be bytes-like object')
+		if not (0 <= offset <= self.__size - len(src)):
 			raise IndexError('offset should out of range')
-		ptr = ctypes.cast(self.__address + offset, ctypes.POINTER(ctypes.c_ubyte))
-		ctypes.memmove(ptr, some_bytes, len(some_bytes))
+		self.as_buffer()[offset:offset+len(src)] = src
 	
 	def remove(self):
 		shmctl(self.id, IPC_RMID)
@@ -213,11 +305,22 @@ class SharedMemory:
 				raise IndexError('index out of range')
 			return self.read(1, index)
 		elif isinstance(index, slice):
-			start, stop, step = index.start or 0, index.stop or self.__size, index.step
-			assert(step is None or step==1)
-			if start < 0: start += self.__size
-			if stop < 0: stop += self.__size
-			return self.read(stop - start, start)
+			start, stop, step = index.indices(self.__size)
+			assert(step==1)
+			return bytes(self.as_buffer()[start:stop])
+		else:
+			raise TypeError('indices must be integer or slice')
+	
+	def __setitem__(self, index, value):
+		if isinstance(index, int):
+			if index < 0: index += self.__size
+			if not (0 <= index < self.__size):
+				raise IndexError('index out of range')
+			self.as_buffer()[index] = value[0] if isinstance(value, (bytes, bytearray)) else value
+		elif isinstance(index, slice):
+			start, stop, step = index.indices(self.__size)
+			assert(step==1)
+			self.as_buffer()[start:stop] = value
 		else:
 			raise TypeError('indices must be integer or slice')
 
@@ -226,19 +329,30 @@ class SharedMemory:
 class sembuf(ctypes.Structure):
 	_fields_ = [('sem_num', ctypes.c_ushort), ('sem_op', ctypes.c_short), ('sem_flg', ctypes.c_short)]
 
-semget = capi.cfunc('semget', 'int', \
+semget = capi.lazy(globals(), 'semget', 'int', \
          ('key', 'int'), ('nsems', 'int'), ('semflg', 'int'))
-semop  = capi.cfunc('semop', 'int', \
-         ('semid', 'int'), ('sops', ctypes.POINTER(sembuf)), ('nsops', 'u_int'))
-semctl = capi.cfunc('semctl', 'int', \
+semop  = capi.lazy(globals(), 'semop', 'int', \
+         ('semid', 'int'), ('sops', ctypes.POINTER(sembuf)), ('nsops', 'u_int'), fast=True)
+semctl = capi.lazy(globals(), 'semctl', 'int', \
          ('semid', 'int'), ('semnum', 'int'), ('cmd', 'int'), ('semid_ds', 'void*', None))
 
+class timespec(ctypes.Structure):
+	_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+semtimedop = capi.lazy(globals(), 'semtimedop', 'int', \
+             ('semid', 'int'), ('sops', ctypes.POINTER(sembuf)), ('nsops', 'u_int'), ('timeout', ctypes.POINTER(timespec)), fast=True)
+
+def _timespec(timeout):
+	timeout = max(timeout, 0.0)
+	return timespec(int(timeout), int((timeout - int(timeout)) * 1e9))
+
 def remove_semaphore(id):
 	semctl(id, 0, IPC_RMID)
 
 class BaseSemaphore:
 	def __init__(self, key, nsems=1, flags=0, mode=0o600, initial_value=0, **kws):
 		self.__values = None
+		self.__prepared = {}
 		if kws.get('not_key') is True:
 			self.__id = key
 			self.__stbuf = semid_ds()
@@ -249,7 +363,7 @@ class BaseSemaphore:
 				try:
 					self.__id = semget(ctypes.c_int(key), nsems, IPC_EXCL|flags|mode)
 					
-					values = [initial_value] * nsems
+					values = list(initial_value) if isinstance(initial_value, (list, tuple)) else [initial_value] * nsems
 					self.__values = (ctypes.c_ushort * nsems)(*values)
 					semctl(self.id, 0, SETALL, self.__values)
 				
@@ -273,7 +387,8 @@ class BaseSemaphore:
 	def __len__(self):
 		return self.__n
 
-	def _op(self, sem_ops):
+	def prepare(self, sem_ops):
+		# validate once and build the sembuf array, the result can be passed to _op() repeatedly
 		n = len(sem_ops)
 		sops = (sembuf * n)()
 		for i in range(n):
@@ -283,7 +398,22 @@ class BaseSemaphore:
 			sops[i].sem_num = num
 			sops[i].sem_op = op
 			sops[i].sem_flg = flags
-		semop(self.id, sops, n)
+		return sops
+	
+	def _op(self, sem_ops, timeout=None):
+		# timeout in seconds uses semtimedop, expiry raises BlockingIOError like IPC_NOWAIT
+		if not isinstance(sem_ops, ctypes.Array):
+			key = tuple(map(tuple, sem_ops))
+			sops = self.__prepared.get(key)
+			if sops is None:
+				sops = self.prepare(sem_ops)
+				if len(self.__prepared) < 256:
+					self.__prepared[key] = sops
+			sem_ops = sops
+		if timeout is None:
+			semop(self.id, sem_ops, len(sem_ops))
+		else:
+			semtimedop(self.id, sem_ops, len(sem_ops), _timespec(timeout))
 	
 	def value(self, index=None):
 		if index is None:
@@ -324,19 +454,19 @@ class Semaphore(BaseSemaphore):
 	def value(self):
 		return super().value(self.__index)
 	
-	def _op(self, delta, block=True, undo=True):
+	def _op(self, delta, block=True, undo=True, timeout=None):
 		sem_flg = 0
 		if delta and undo: sem_flg |= SEM_UNDO
 		if not block: sem_flg |= IPC_NOWAIT
-		super()._op([(self.__index, delta, sem_flg)])
+		super()._op(((self.__index, delta, sem_flg),), timeout)
 	
-	def acquire(self, delta=1, block=True, undo=True):
+	def acquire(self, delta=1, block=True, undo=True, timeout=None):
 		assert(delta > 0)
-		self._op(-delta, block, undo)
+		self._op(-delta, block, undo, timeout)
 	
-	def release(self, delta=1):
+	def release(self, delta=1, undo=True):
 		assert(delta > 0)
-		self._op(delta, block=False)
+		self._op(delta, block=False, undo=undo)
 	
 	def P(self, block=True):
 		self._op(-1, block)
@@ -344,5 +474,1225 @@ class Semaphore(BaseSemaphore):
 	def V(self):
 		self._op(1, block=False)
 	
-	def Z(self, block=True):
-		self._op(0, block, undo=False)
+	def Z(self, block=True, timeout=None):
+		self._op(0, block, undo=False, timeout=timeout)
+
+class Lock(Semaphore):
+	# process-shared mutex, SEM_UNDO releases it if the owner dies
+	def __init__(self, key, flags=0, mode=0o600, **kws):
+		super().__init__(key, flags, mode, 1, **kws)
+		index = kws.get('index', 0)
+		self.__acquire = self.prepare([(index, -1, SEM_UNDO)])
+		self.__try_acquire = self.prepare([(index, -1, SEM_UNDO|IPC_NOWAIT)])
+		# the zero test fails with EAGAIN unless the lock is held, so a double release can't push the value past 1
+		self.__release = self.prepare([(index, 0, IPC_NOWAIT), (index, 1, SEM_UNDO|IPC_NOWAIT)])
+	
+	def acquire(self, block=True, timeout=None):
+		try:
+			if not block:
+				BaseSemaphore._op(self, self.__try_acquire)
+			else:
+				BaseSemaphore._op(self, self.__acquire, timeout)
+			return True
+		except BlockingIOError:
+			return False
+	
+	def release(self):
+		try:
+			BaseSemaphore._op(self, self.__release)
+		except BlockingIOError:
+			raise RuntimeError('release unlocked lock') from None
+	
+	@property
+	def locked(self):
+		return self.value == 0
+	
+	def __enter__(self):
+		self.acquire()
+		return self
+	
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.release()
+
+class RWLock(BaseSemaphore):
+	# readers-writer lock, waiting writers block new readers so writers are not starved
+	READERS, WRITER, WAITING = range(3)
+	
+	def __init__(self, key, flags=0, mode=0o600, **kws):
+		super().__init__(key, 3, flags, mode, 0, **kws)
+		R, W, Q = self.READERS, self.WRITER, self.WAITING
+		self.__read = self.prepare([(Q, 0, 0), (W, 0, 0), (R, 1, SEM_UNDO)])
+		self.__try_read = self.prepare([(Q, 0, IPC_NOWAIT), (W, 0, IPC_NOWAIT), (R, 1, SEM_UNDO|IPC_NOWAIT)])
+		self.__read_done = self.prepare([(R, -1, SEM_UNDO|IPC_NOWAIT)])
+		self.__queue = self.prepare([(Q, 1, SEM_UNDO|IPC_NOWAIT)])
+		self.__dequeue = self.prepare([(Q, -1, SEM_UNDO|IPC_NOWAIT)])
+		self.__write = self.prepare([(W, 0, 0), (R, 0, 0), (W, 1, SEM_UNDO), (Q, -1, SEM_UNDO)])
+		self.__try_write = self.prepare([(W, 0, IPC_NOWAIT), (R, 0, IPC_NOWAIT), (W, 1, SEM_UNDO|IPC_NOWAIT)])
+		self.__write_done = self.prepare([(W, -1, SEM_UNDO|IPC_NOWAIT)])
+	
+	def acquire_read(self, block=True, timeout=None):
+		try:
+			if not block:
+				self._op(self.__try_read)
+			else:
+				self._op(self.__read, timeout)
+			return True
+		except BlockingIOError:
+			return False
+	
+	def release_read(self):
+		self._op(self.__read_done)
+	
+	def acquire_write(self, block=True, timeout=None):
+		try:
+			if not block:
+				self._op(self.__try_write)
+				return True
+			self._op(self.__queue)
+			try:
+				self._op(self.__write, timeout)
+			except BaseException:
+				self._op(self.__dequeue)
+				raise
+			return True
+		except BlockingIOError:
+			return False
+	
+	def release_write(self):
+		self._op(self.__write_done)
+	
+	@contextlib.contextmanager
+	def reading(self):
+		self.acquire_read()
+		try:
+			yield self
+		finally:
+			self.release_read()
+	
+	@contextlib.contextmanager
+	def writing(self):
+		self.acquire_write()
+		try:
+			yield self
+		finally:
+			self.release_write()
+
+class Barrier(BaseSemaphore):
+	# reusable counting barrier for a fixed number of processes, gates alternate between generations
+	COUNT, PHASE, GATE0, GATE1 = range(4)
+	
+	def __init__(self, key, parties=2, flags=0, mode=0o600, **kws):
+		super().__init__(key, 4, flags, mode, [parties, 0, 0, 0], **kws)
+		# every process must pass the same parties, it is used to reset the count
+		self.parties = parties
+		self.__arrive = self.prepare([(self.COUNT, -2, IPC_NOWAIT), (self.COUNT, 1, 0)])
+	
+	def wait(self):
+		# returns True in the process that arrived last and released the others
+		phase = self.value(self.PHASE)
+		gate = self.GATE1 if phase else self.GATE0
+		try:
+			self._op(self.__arrive)
+		except BlockingIOError:
+			# count is 1: everybody else already arrived, reset for the next generation and open the gate
+			ops = [(self.PHASE, -1 if phase else 1, 0)]
+			if self.parties > 1:
+				ops += [(self.COUNT, self.parties - 1, 0), (gate, self.parties - 1, 0)]
+			self._op(ops)
+			return True
+		self._op([(gate, -1, 0)])
+		return False
+
+
+################################################# Ring Buffer ###############################################
+
+class RingBuffer:
+	# Framed records in a SharedMemory circular buffer, each record takes whole blocks of `block` bytes.
+	# Semaphores: free blocks, ready records, and producer/consumer mutexes (unused when spsc=True).
+	# Only producers move tail and only consumers move head, so each side reads just its own cursor.
+	HEADER = struct.Struct('QQQQQ')   # magic, capacity, block, head, tail
+	MAGIC = 0x52494e4742554631
+	SPACE, ITEMS, PUSH_LOCK, POP_LOCK = range(4)
+	
+	def __init__(self, key, capacity=1<<20, flags=0, mode=0o600, block=64, spsc=False, **kws):
+		if kws.get('not_key') is True:
+			shm_id, sem_id = key
+			self.shm = SharedMemory(shm_id, not_key=True)
+			self.sem = BaseSemaphore(sem_id, not_key=True)
+		else:
+			nblocks = capacity // block
+			if not (0 < nblocks <= 32767):
+				raise ValueError('capacity/block must be in 1..32767')
+			# an existing segment is opened with size 0, shmget fails when it is smaller than asked
+			self.shm = SharedMemory(key, self.HEADER.size + nblocks*block if flags & IPC_CREAT else 0, flags, mode)
+			self.sem = BaseSemaphore(key, 4, flags, mode, initial_value=[nblocks, 0, 1, 1])
+		self.shm.attach()
+		self.__buf = self.shm.as_buffer()
+		magic = self.HEADER.unpack_from(self.__buf)[0]
+		if magic != self.MAGIC:
+			if not (flags & IPC_CREAT):
+				raise ValueError('shared memory is not a ring buffer')
+			self.HEADER.pack_into(self.__buf, 0, self.MAGIC, nblocks * block, block, 0, 0)
+		magic, capacity, block, _, _ = self.HEADER.unpack_from(self.__buf)
+		self.capacity, self.block, self.spsc = capacity, block, spsc
+		self.__data = self.__buf[self.HEADER.size:self.HEADER.size+capacity]
+		self.__cursors, self.__semid = self.__buf[24:40].cast('Q'), self.sem.id
+		# sembuf arrays are built once: the fixed ones here, the ones sized by a record's blocks on first use
+		self.__sops = {}
+		self.__push_done = self.__prepare(((self.PUSH_LOCK, 1), (self.ITEMS, 1)), True)
+		self.__pop_start = [self.__prepare(((self.ITEMS, -1), (self.POP_LOCK, -1)), block) for block in (False, True)]
+	
+	@property
+	def ids(self):
+		return (self.shm.id, self.sem.id)
+	
+	def __len__(self):
+		return self.sem.value(self.ITEMS)
+	
+	def free_blocks(self):
+		return self.sem.value(self.SPACE)
+	
+	def close(self):
+		self.__cursors = self.__data = self.__buf = None
+		self.shm.detach()
+	
+	def remove(self):
+		self.close()
+		self.shm.remove()
+		self.sem.remove()
+	
+	def __cursor(self, index):
+		return self.__cursors[index]
+	
+	def __set_cursor(self, index, value):
+		self.__cursors[index] = value
+	
+	def __blocks(self, size):
+		return (4 + size + self.block - 1) // self.block
+	
+	def __copy_in(self, pos, data):
+		pos %= self.capacity
+		n = min(len(data), self.capacity - pos)
+		self.__data[pos:pos+n] = data[:n]
+		if n < len(data):
+			self.__data[:len(data)-n] = data[n:]
+	
+	def __copy_out(self, pos, size):
+		pos %= self.capacity
+		n = min(size, self.capacity - pos)
+		if n == size:
+			return bytes(self.__data[pos:pos+n])
+		return bytes(self.__data[pos:pos+n]) + bytes(self.__data[:size-n])
+	
+	def __prepare(self, ops, block):
+		# the mutexes take SEM_UNDO and are left out with spsc, a zero sem_op would wait for zero
+		return self.sem.prepare([(num, op, (SEM_UNDO if num >= self.PUSH_LOCK else 0) | (0 if block else IPC_NOWAIT))
+		                         for num, op in ops if op and not (self.spsc and num >= self.PUSH_LOCK)])
+	
+	def __sized(self, kind, k, block=True):
+		sops = self.__sops.get((kind, k, block))
+		if sops is None:
+			if kind:
+				sops = self.__prepare(((self.POP_LOCK, 1), (self.SPACE, k)), True)
+			else:
+				sops = self.__prepare(((self.SPACE, -k), (self.PUSH_LOCK, -1)), block)
+			if len(self.__sops) < 1024:
+				self.__sops[(kind, k, block)] = sops
+		return sops
+	
+	def __semop(self, sops):
+		try:
+			semop(self.__semid, sops, len(sops))
+			return True
+		except BlockingIOError:
+			return False
+	
+	def __acquire(self, ops, block):
+		return self.__semop(self.__prepare(ops, block))
+	
+	def __release(self, ops):
+		self.__semop(self.__prepare(ops, True))
+	
+	def push(self, message, block=True):
+		message = memoryview(message.encode() if isinstance(message, str) else message).cast('B')
+		size = len(message)
+		k = (4 + size + self.block - 1) // self.block
+		if k > min(32767, self.capacity // self.block):
+			raise OSError(errno.E2BIG, 'The message is larger than the ring buffer')
+		sops = self.__sops.get((0, k, block)) or self.__sized(0, k, block)
+		try:
+			semop(self.__semid, sops, len(sops))
+		except BlockingIOError:
+			return False
+		try:
+			tail = self.__cursors[1]
+			pos = tail % self.capacity
+			if pos + 4 + size <= self.capacity:
+				struct.pack_into('I', self.__data, pos, size)
+				self.__data[pos+4:pos+4+size] = message
+			else:
+				self.__copy_in(tail, struct.pack('I', size))
+				self.__copy_in(tail + 4, message)
+			self.__cursors[1] = tail + k * self.block
+		finally:
+			semop(self.__semid, self.__push_done, len(self.__push_done))
+		return True
+	
+	def push_many(self, messages, block=True):
+		messages = [memoryview(message.encode() if isinstance(message, str) else message).cast('B') for message in messages]
+		blocks = [self.__blocks(len(message)) for message in messages]
+		if sum(blocks) > min(32767, self.capacity // self.block):
+			raise OSError(errno.E2BIG, 'The messages are larger than the ring buffer')
+		if not self.__semop(self.__sized(0, sum(blocks), block)):
+			return 0
+		try:
+			tail = self.__cursor(1)
+			for message, k in zip(messages, blocks):
+				self.__copy_in(tail, struct.pack('I', len(message)))
+				self.__copy_in(tail + 4, message)
+				tail += k * self.block
+			self.__set_cursor(1, tail)
+		finally:
+			self.__release([(self.PUSH_LOCK, 1), (self.ITEMS, len(messages))])
+		return len(messages)
+	
+	def pop(self, block=True):
+		sops = self.__pop_start[block]
+		try:
+			semop(self.__semid, sops, len(sops))
+		except BlockingIOError:
+			return None
+		k = 0
+		try:
+			head = self.__cursors[0]
+			pos = head % self.capacity
+			if pos + 4 <= self.capacity:
+				size = struct.unpack_from('I', self.__data, pos)[0]
+			else:
+				size = struct.unpack('I', self.__copy_out(head, 4))[0]
+			if pos + 4 + size <= self.capacity:
+				message = bytes(self.__data[pos+4:pos+4+size])
+			else:
+				message = self.__copy_out(head + 4, size)
+			k = (4 + size + self.block - 1) // self.block
+			self.__cursors[0] = head + k * self.block
+		finally:
+			sops = self.__sops.get((1, k, True)) or self.__sized(1, k)
+			if len(sops):
+				semop(self.__semid, sops, len(sops))
+		return message
+	
+	def pop_many(self, max_count=64, block=True):
+		if not self.__semop(self.__pop_start[block]):
+			return []
+		n, blocks, messages = 1, 0, []
+		try:
+			more = min(max_count - 1, self.sem.value(self.ITEMS))
+			if more > 0 and self.__acquire([(self.ITEMS, -more)], False):
+				n += more
+			head = self.__cursor(0)
+			for _ in range(n):
+				size = struct.unpack('I', self.__copy_out(head, 4))[0]
+				messages.append(self.__copy_out(head + 4, size))
+				k = self.__blocks(size)
+				head += k * self.block
+				blocks += k
+			self.__set_cursor(0, head)
+		finally:
+			sops = self.__sized(1, blocks)
+			if len(sops):
+				semop(self.__semid, sops, len(sops))
+		return messages
+
+############################################### Shared Hash Table ###########################################
+
+class SharedHashTable:
+	# Fixed-capacity bytes->bytes table in a SharedMemory segment, split into `stripes` segments each
+	# guarded by one semaphore of a BaseSemaphore set, linear probing inside a segment.
+	# Readers take no lock: every slot carries a seqlock version that writers make odd while writing.
+	# With evict=True a full segment reuses slots with the CLOCK policy.
+	MAGIC = 0x5348415348544231
+	HEADER = struct.Struct('QQQQQ')    # magic, slots, stripes, key_max, value_max
+	SEGMENT = struct.Struct('QQ')      # clock hand, count
+	SLOT = struct.Struct('BBHIQII')    # state, referenced, key length, version, hash, value length, pad
+	EMPTY, USED, DELETED = 0, 1, 2
+	
+	def __init__(self, key, slots=4096, flags=0, mode=0o600, key_max=64, value_max=256, stripes=16, evict=False, **kws):
+		if kws.get('not_key') is True:
+			shm_id, sem_id = key
+			self.shm = SharedMemory(shm_id, not_key=True)
+			self.sem = BaseSemaphore(sem_id, not_key=True)
+		else:
+			slots = (slots + stripes - 1) // stripes * stripes
+			size = self.__header_size(stripes) + slots * self.__slot_size(key_max, value_max)
+			self.shm = SharedMemory(key, size if flags & IPC_CREAT else 0, flags, mode)
+			self.sem = BaseSemaphore(key, stripes, flags, mode, initial_value=1)
+		self.shm.attach()
+		self.__buf = self.shm.as_buffer()
+		if self.HEADER.unpack_from(self.__buf)[0] != self.MAGIC:
+			if not (flags & IPC_CREAT):
+				raise ValueError('shared memory is not a hash table')
+			self.HEADER.pack_into(self.__buf, 0, self.MAGIC, slots, stripes, key_max, value_max)
+		_, self.slots, self.stripes, self.key_max, self.value_max = self.HEADER.unpack_from(self.__buf)
+		self.evict = evict
+		self.__segment_slots = self.slots // self.stripes
+		self.__slot_size = self.__slot_size(self.key_max, self.value_max)
+		self.__data = self.__header_size(self.stripes)
+	
+	@staticmethod
+	def __header_size(stripes):
+		return (SharedHashTable.HEADER.size + SharedHashTable.SEGMENT.size * stripes + 63) // 64 * 64
+	
+	@staticmethod
+	def __slot_size(key_max, value_max):
+		return (SharedHashTable.SLOT.size + key_max + value_max + 7) // 8 * 8
+	
+	@property
+	def ids(self):
+		return (self.shm.id, self.sem.id)
+	
+	def close(self):
+		self.__buf = None
+		self.shm.detach()
+	
+	def remove(self):
+		self.close()
+		self.shm.remove()
+		self.sem.remove()
+	
+	@staticmethod
+	def __hash(key):
+		return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+	
+	def __segment(self, h):
+		return h % self.stripes
+	
+	def __probe(self, h):
+		seg = h % self.stripes
+		n = self.__segment_slots
+		first = seg * n
+		home = (h // self.stripes) % n
+		for i in range(n):
+			yield first + (home + i) % n
+	
+	def __offset(self, slot):
+		return self.__data + slot * self.__slot_size
+	
+	def __get_segment(self, seg):
+		return self.SEGMENT.unpack_from(self.__buf, self.HEADER.size + seg * self.SEGMENT.size)
+	
+	def __set_segment(self, seg, hand, count):
+		self.SEGMENT.pack_into(self.__buf, self.HEADER.size + seg * self.SEGMENT.size, hand, count)
+	
+	def __len__(self):
+		return sum(self.__get_segment(seg)[1] for seg in range(self.stripes))
+	
+	def __find(self, key, h):
+		# returns (slot, value) of the key, or (None, None); lock-free, retried on concurrent writes
+		buf, SLOT = self.__buf, self.SLOT
+		while True:
+			for slot in self.__probe(h):
+				offset = self.__offset(slot)
+				state, _, keylen, version, slot_hash, vallen, _ = SLOT.unpack_from(buf, offset)
+				if state == self.EMPTY:
+					return None, None
+				if state != self.USED or slot_hash != h or keylen != len(key):
+					continue
+				start = offset + SLOT.size
+				if buf[start:start+keylen] != key:
+					continue
+				value = bytes(buf[start+self.key_max:start+self.key_max+vallen])
+				if version & 1 or SLOT.unpack_from(buf, offset)[3] != version:
+					break
+				buf[offset+1] = 1
+				return slot, value
+			else:
+				return None, None
+	
+	def get(self, key, default=None):
+		slot, value = self.__find(key, self.__hash(key))
+		return default if slot is None else value
+	
+	def __getitem__(self, key):
+		slot, value = self.__find(key, self.__hash(key))
+		if slot is None:
+			raise KeyError(key)
+		return value
+	
+	def __contains__(self, key):
+		return self.__find(key, self.__hash(key))[0] is not None
+	
+	def __write(self, slot, state, h=0, key=b'', value=b''):
+		offset = self.__offset(slot)
+		version = self.SLOT.unpack_from(self.__buf, offset)[3]
+		struct.pack_into('I', self.__buf, offset+4, (version + 1) & 0xffffffff)
+		if state == self.USED:
+			start = offset + self.SLOT.size
+			self.__buf[start:start+len(key)] = key
+			self.__buf[start+self.key_max:start+self.key_max+len(value)] = value
+		self.SLOT.pack_into(self.__buf, offset, state, 1, len(key), (version + 1) & 0xffffffff, h, len(value), 0)
+		struct.pack_into('I', self.__buf, offset+4, (version + 2) & 0xffffffff)
+	
+	def set(self, key, value):
+		# returns False when the segment is full and eviction is off
+		key, value = bytes(key), bytes(value)
+		if len(key) > self.key_max or len(value) > self.value_max:
+			raise OSError(errno.E2BIG, 'key or value is larger than key_max/value_max')
+		h = self.__hash(key)
+		seg = self.__segment(h)
+		self.sem._op([(seg, -1, SEM_UNDO)])
+		try:
+			hand, count = self.__get_segment(seg)
+			slot, _ = self.__find(key, h)
+			if slot is not None:
+				self.__write(slot, self.USED, h, key, value)
+				return True
+			for slot in self.__probe(h):
+				if self.__buf[self.__offset(slot)] != self.USED:
+					self.__write(slot, self.USED, h, key, value)
+					self.__set_segment(seg, hand, count + 1)
+					return True
+			if not self.evict:
+				return False
+			slot = self.__clock(seg, hand)
+			self.__write(slot, self.USED, h, key, value)
+			return True
+		finally:
+			self.sem._op([(seg, 1, SEM_UNDO)])
+	
+	def __clock(self, seg, hand):
+		# second chance: clear referenced bits until an unreferenced slot comes under the hand.
+		# The victim is overwritten in place, which keeps every other probe chain intact.
+		n, first = self.__segment_slots, seg * self.__segment_slots
+		while True:
+			slot = first + hand % n
+			hand = (hand + 1) % n
+			offset = self.__offset(slot)
+			if self.__buf[offset+1]:
+				self.__buf[offset+1] = 0
+			else:
+				self.__set_segment(seg, hand, self.__get_segment(seg)[1])
+				return slot
+	
+	def __setitem__(self, key, value):
+		if not self.set(key, value):
+			raise MemoryError('shared hash table segment is full')
+	
+	def delete(self, key):
+		h = self.__hash(key)
+		seg = self.__segment(h)
+		self.sem._op([(seg, -1, SEM_UNDO)])
+		try:
+			slot, _ = self.__find(key, h)
+			if slot is None:
+				return False
+			self.__write(slot, self.DELETED)
+			hand, count = self.__get_segment(seg)
+			self.__set_segment(seg, hand, count - 1)
+			return True
+		finally:
+			self.sem._op([(seg, 1, SEM_UNDO)])
+	
+	def __delitem__(self, key):
+		if not self.delete(key):
+			raise KeyError(key)
+
+############################################# Shared Counters ###############################################
+
+class _Slot:
+	# per-thread slot of a SharedCounters segment, given back when the owning thread ends
+	def __init__(self, counters, index, buf):
+		self.counters, self.index, self.pid = counters, index, os.getpid()
+		self.q, self.d = buf.cast('q'), buf.cast('d')
+	
+	def __del__(self):
+		if os.getpid() == self.pid and self.counters is not None:
+			self.counters._free(self)
+
+class SharedCounters:
+	# Monotonic int64 counters in a SharedMemory segment. Every writing thread owns a cache-line aligned
+	# slot and adds to it without locking, readers sum all slots. A slot keeps its counts when its owner
+	# exits so totals never go backwards; the semaphore only guards claiming a slot.
+	MAGIC = 0x5343544552533031
+	HEADER = struct.Struct('QQQQ')    # magic, slots, cells, names length
+	
+	def __init__(self, key, names=(), slots=256, flags=0, mode=0o600, **kws):
+		if kws.get('not_key') is True:
+			shm_id, sem_id = key
+			self.shm = SharedMemory(shm_id, not_key=True)
+			self.lock = Lock(sem_id, not_key=True)
+		else:
+			encoded = '\0'.join(names).encode('utf-8')
+			size = self.__header_size(len(encoded)) + slots * self.__stride(len(names))
+			self.shm = SharedMemory(key, size if flags & IPC_CREAT else 0, flags, mode)
+			self.lock = Lock(key, flags, mode)
+		self.shm.attach()
+		self.__buf = self.shm.as_buffer()
+		if self.HEADER.unpack_from(self.__buf)[0] != self.MAGIC:
+			if not (flags & IPC_CREAT):
+				raise ValueError('shared memory is not a counter set')
+			self.__buf[self.HEADER.size:self.HEADER.size+len(encoded)] = encoded
+			self.HEADER.pack_into(self.__buf, 0, self.MAGIC, slots, len(names), len(encoded))
+		_, self.slots, cells, length = self.HEADER.unpack_from(self.__buf)
+		encoded = bytes(self.__buf[self.HEADER.size:self.HEADER.size+length])
+		self.names = encoded.decode('utf-8').split('\0') if cells else []
+		self.__index = {name: i+1 for i, name in enumerate(self.names)}
+		self.__data, self.__stride = self.__header_size(length), self.__stride(cells)
+		self._thread = threading.local()
+		_counters.add(self)
+	
+	@staticmethod
+	def __header_size(length):
+		return (SharedCounters.HEADER.size + length + 63) // 64 * 64
+	
+	@staticmethod
+	def __stride(cells):
+		# cell 0 is the owner pid
+		return ((cells + 1) * 8 + 63) // 64 * 64
+	
+	@property
+	def ids(self):
+		return (self.shm.id, self.lock.id)
+	
+	def close(self):
+		self._thread = threading.local()
+		self.__buf = None
+		self.shm.detach()
+	
+	def remove(self):
+		self.close()
+		self.shm.remove()
+		self.lock.remove()
+	
+	def _after_fork(self):
+		self._thread = threading.local()
+	
+	def __view(self, slot):
+		offset = self.__data + slot * self.__stride
+		return self.__buf[offset:offset+self.__stride]
+	
+	def __claim(self):
+		pid = os.getpid()
+		with self.lock:
+			for i in range(self.slots):
+				view = self.__view(i).cast('q')
+				owner = view[0]
+				if owner:
+					try:
+						os.kill(owner, 0)
+						continue
+					except ProcessLookupError:
+						pass
+					except PermissionError:
+						continue
+				view[0] = pid
+				return _Slot(self, i, self.__view(i))
+		raise OSError(errno.ENOSPC, 'no free counter slot')
+	
+	def _free(self, slot):
+		if self.__buf is not None:
+			slot.q[0] = 0
+		slot.counters = None
+	
+	def _claim_thread(self):
+		thread = self._thread
+		thread.slot = slot = self.__claim()
+		thread.q, thread.d = slot.q, slot.d
+		return thread
+	
+	def index(self, name):
+		return self.__index[name]
+	
+	def incr(self, name, n=1):
+		try:
+			self._thread.q[self.__index[name]] += n
+		except AttributeError:
+			self._claim_thread().q[self.__index[name]] += n
+	
+	def add(self, index, n=1):
+		# hot path form of incr() with an index from index(name)
+		try:
+			self._thread.q[index] += n
+		except AttributeError:
+			self._claim_thread().q[index] += n
+	
+	def __getitem__(self, name):
+		i = self.__index[name]
+		return sum(self.__view(slot).cast('q')[i] for slot in range(self.slots))
+	
+	def _totals(self, fmt='q'):
+		totals = [0] * (len(self.names) + 1)
+		for slot in range(self.slots):
+			view = self.__view(slot).cast(fmt)
+			for i in range(1, len(totals)):
+				totals[i] += view[i]
+		return totals
+	
+	def snapshot(self):
+		return dict(zip(self.names, self._totals()[1:]))
+	
+	def export(self, put, prefix='', timestamp=None, **tags):
+		# put(metric, timestamp, value, **tags), e.g. tsdb.TSDB.put
+		timestamp = int(time.time()) if timestamp is None else timestamp
+		for name, value in self.snapshot().items():
+			put(prefix + name, timestamp, value, **tags)
+
+class SharedHistogram(SharedCounters):
+	# bucket counts plus a float64 sum cell, bounds are upper bounds like tsdb.Stats
+	BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+	
+	def __init__(self, key, bounds=BOUNDS, slots=256, flags=0, mode=0o600, **kws):
+		bounds = sorted(bounds)
+		if bounds[-1] != float('inf'):
+			bounds.append(float('inf'))
+		super().__init__(key, ['le_%g'%bound for bound in bounds] + ['sum'], slots, flags, mode, **kws)
+		self.bounds = [float(name[3:]) for name in self.names[:-1]]
+		self.__sum = len(self.names)
+	
+	def observe(self, value):
+		try:
+			thread = self._thread
+			thread.q[bisect.bisect_left(self.bounds, value) + 1] += 1
+		except AttributeError:
+			thread = self._claim_thread()
+			thread.q[bisect.bisect_left(self.bounds, value) + 1] += 1
+		thread.d[self.__sum] += value
+	
+	def snapshot(self):
+		counts = self._totals()[1:-1]
+		count, total = sum(counts), self._totals('d')[self.__sum]
+		result = dict(zip(self.names, counts), count=count, sum=total, avg=total/count if count else 0.0)
+		for q in (0.5, 0.99):
+			rank, seen = q * count, 0
+			for bound, n in zip(self.bounds, counts):
+				seen += n
+				if seen >= rank:
+					break
+			result['p%g'%(q*100)] = bound if count else 0.0
+		return result
+
+_counters = weakref.WeakSet()
+if hasattr(os, 'register_at_fork'):
+	os.register_at_fork(after_in_child=lambda: [counters._after_fork() for counters in list(_counters)])
+
+############################################ Shared Allocator ###############################################
+
+class SharedAllocator:
+	# Slab allocator over a SharedMemory segment. The segment is cut into fixed-size slabs, each slab
+	# serves one size class (geometric, so internal waste is bounded by `factor`), freed blocks go on a
+	# per-slab free list threaded through the blocks themselves and the class links its slabs with free
+	# blocks. A class slab whose blocks are all free goes back to the slab table in O(1), so memory moves
+	# between classes. Larger requests take a run of whole slabs. Handles are offsets into the segment
+	# and valid in every attached process, 0 is never returned. One Lock guards all metadata.
+	MAGIC = 0x534c414241303033
+	HEADER = struct.Struct('QQQQ')      # magic, slab size, slabs, classes
+	CLASS = struct.Struct('QQQQQQ')     # block size, first slab with free blocks + 1, carve offset, carve end, used blocks, slabs
+	SLAB = struct.Struct('IIIIQ')       # owner (0 free, class index + 1, or LARGE), run length or live blocks,
+	                                    # next and previous slab with free blocks + 1, free list head
+	LARGE = 0xffffffff
+	
+	def __init__(self, key, size=1<<24, flags=0, mode=0o600, slab_size=1<<16, min_size=16, factor=1.25, **kws):
+		if kws.get('not_key') is True:
+			shm_id, sem_id = key
+			self.shm = SharedMemory(shm_id, not_key=True)
+			self.lock = Lock(sem_id, not_key=True)
+		else:
+			classes = self.__classes(min_size, factor, slab_size)
+			slabs = max(1, (size - self.__meta_size(len(classes), size // slab_size)) // slab_size)
+			size = self.__meta_size(len(classes), slabs) + slabs * slab_size
+			self.shm = SharedMemory(key, size if flags & IPC_CREAT else 0, flags, mode)
+			self.lock = Lock(key, flags, mode)
+		self.shm.attach()
+		self.__buf = self.shm.as_buffer()
+		if self.HEADER.unpack_from(self.__buf)[0] != self.MAGIC:
+			if not (flags & IPC_CREAT):
+				raise ValueError('shared memory is not an allocator')
+			for i, block in enumerate(classes):
+				self.CLASS.pack_into(self.__buf, self.HEADER.size + i * self.CLASS.size, block, 0, 0, 0, 0, 0)
+			self.HEADER.pack_into(self.__buf, 0, self.MAGIC, slab_size, slabs, len(classes))
+		_, self.slab_size, self.slabs, n = self.HEADER.unpack_from(self.__buf)
+		self.__class_table = self.HEADER.size
+		self.__slab_table = self.__class_table + n * self.CLASS.size
+		self.__data = self.__meta_size(n, self.slabs)
+		self.classes = [self.CLASS.unpack_from(self.__buf, self.__class_table + i * self.CLASS.size)[0] for i in range(n)]
+		self.__words = self.__buf.cast('Q')
+	
+	@staticmethod
+	def __classes(min_size, factor, slab_size):
+		classes, size = [], max(8, (min_size + 7) & ~7)
+		while size <= slab_size // 2:
+			classes.append(size)
+			size = max(size + 8, (int(size * factor) + 7) & ~7)
+		return classes
+	
+	@staticmethod
+	def __meta_size(classes, slabs):
+		size = SharedAllocator.HEADER.size + classes * SharedAllocator.CLASS.size + slabs * SharedAllocator.SLAB.size
+		return (size + 63) // 64 * 64
+	
+	@property
+	def ids(self):
+		return (self.shm.id, self.lock.id)
+	
+	def close(self):
+		self.__words = self.__buf = None
+		self.shm.detach()
+	
+	def remove(self):
+		self.close()
+		self.shm.remove()
+		self.lock.remove()
+	
+	def __get_class(self, i):
+		return list(self.CLASS.unpack_from(self.__buf, self.__class_table + i * self.CLASS.size))
+	
+	def __set_class(self, i, fields):
+		self.CLASS.pack_into(self.__buf, self.__class_table + i * self.CLASS.size, *fields)
+	
+	def __get_slab(self, i):
+		return list(self.SLAB.unpack_from(self.__buf, self.__slab_table + i * self.SLAB.size))
+	
+	def __set_slab(self, i, fields):
+		self.SLAB.pack_into(self.__buf, self.__slab_table + i * self.SLAB.size, *fields)
+	
+	def __set_slabs(self, first, count, owner):
+		for i in range(first, first + count):
+			self.__set_slab(i, (owner, count if i == first else 0, 0, 0, 0))
+	
+	def __link(self, fields, slab, entry):
+		# push a slab that just got a free block on its class list
+		entry[2], entry[3] = fields[1], 0
+		if fields[1]:
+			after = self.__get_slab(fields[1] - 1)
+			after[3] = slab + 1
+			self.__set_slab(fields[1] - 1, after)
+		fields[1] = slab + 1
+	
+	def __unlink(self, fields, slab, entry):
+		# drop a slab from its class list, when its free list ran dry or the slab is released
+		if entry[3]:
+			before = self.__get_slab(entry[3] - 1)
+			before[2] = entry[2]
+			self.__set_slab(entry[3] - 1, before)
+		else:
+			fields[1] = entry[2]
+		if entry[2]:
+			after = self.__get_slab(entry[2] - 1)
+			after[3] = entry[3]
+			self.__set_slab(entry[2] - 1, after)
+		entry[2] = entry[3] = 0
+	
+	def __find_slabs(self, count):
+		# first fit over the slab table
+		run = 0
+		for i in range(self.slabs):
+			owner, length = self.__get_slab(i)[:2]
+			if owner:
+				run = 0
+				continue
+			run += 1
+			if run == count:
+				return i - count + 1
+		raise MemoryError('shared allocator has no %d free slabs'%count)
+	
+	def __slab_of(self, handle):
+		slab = (handle - self.__data) // self.slab_size
+		if handle < self.__data or slab >= self.slabs:
+			raise ValueError('handle is out of range')
+		return slab
+	
+	def alloc(self, size):
+		if size <= 0:
+			raise ValueError('size must be positive')
+		index = bisect.bisect_left(self.classes, size)
+		with self.lock:
+			if index == len(self.classes):
+				count = (size + self.slab_size - 1) // self.slab_size
+				first = self.__find_slabs(count)
+				self.__set_slabs(first, count, self.LARGE)
+				return self.__data + first * self.slab_size
+			fields = self.__get_class(index)
+			block, partial, carve, end, used, slabs = fields
+			if partial:
+				slab = partial - 1
+				entry = self.__get_slab(slab)
+				handle = entry[4]
+				entry[4] = self.__words[handle // 8]
+				if not entry[4]:
+					self.__unlink(fields, slab, entry)
+			else:
+				if carve + block > end:
+					slab = self.__find_slabs(1)
+					self.__set_slab(slab, (index + 1, 0, 0, 0, 0))
+					carve = self.__data + slab * self.slab_size
+					fields[3], fields[5] = carve + self.slab_size, slabs + 1
+				slab = (carve - self.__data) // self.slab_size
+				entry = self.__get_slab(slab)
+				handle, fields[2] = carve, carve + block
+			entry[1] += 1
+			fields[4] += 1
+			self.__set_slab(slab, entry)
+			self.__set_class(index, fields)
+			return handle
+	
+	def free(self, handle):
+		slab = self.__slab_of(handle)
+		with self.lock:
+			entry = self.__get_slab(slab)
+			owner, length = entry[0], entry[1]
+			if owner == self.LARGE and length:
+				self.__set_slabs(slab, length, 0)
+			elif owner and owner != self.LARGE:
+				fields = self.__get_class(owner - 1)
+				self.__words[handle // 8] = entry[4]
+				if not entry[4]:
+					self.__link(fields, slab, entry)
+				entry[4] = handle
+				entry[1] -= 1
+				fields[4] -= 1
+				# the slab being carved is kept, so one alloc/free pair does not cycle a slab
+				if not entry[1] and fields[3] != self.__data + (slab + 1) * self.slab_size:
+					self.__unlink(fields, slab, entry)
+					self.__set_slabs(slab, 1, 0)
+					fields[5] -= 1
+				else:
+					self.__set_slab(slab, entry)
+				self.__set_class(owner - 1, fields)
+			else:
+				raise ValueError('handle was not allocated')
+	
+	def size_of(self, handle):
+		owner, length = self.__get_slab(self.__slab_of(handle))[:2]
+		if owner == self.LARGE:
+			return length * self.slab_size
+		if not owner:
+			raise ValueError('handle was not allocated')
+		return self.classes[owner - 1]
+	
+	def view(self, handle, size=None):
+		# writable memoryview of an allocation, valid until close()
+		size = self.size_of(handle) if size is None else size
+		return self.__buf[handle:handle+size]
+	
+	def stats(self):
+		# bytes in class slabs that are neither used nor carvable count as free-list waste
+		with self.lock:
+			classes, large, free_slabs = [], 0, 0
+			for i in range(self.slabs):
+				owner, length = self.__get_slab(i)[:2]
+				if not owner:
+					free_slabs += 1
+				elif owner == self.LARGE:
+					large += 1
+			for i in range(len(self.classes)):
+				block, head, carve, end, used, slabs = self.__get_class(i)
+				if slabs:
+					capacity = slabs * (self.slab_size // block)
+					carvable = (end - carve) // block
+					classes.append(dict(block_size=block, slabs=slabs, used=used, free=capacity - used - carvable,
+					                    carvable=carvable))
+		used_bytes = sum(c['block_size'] * c['used'] for c in classes) + large * self.slab_size
+		free_list_bytes = sum(c['block_size'] * c['free'] for c in classes)
+		return dict(slab_size=self.slab_size, slabs=self.slabs, free_slabs=free_slabs, large_slabs=large,
+		            used_bytes=used_bytes, free_list_bytes=free_list_bytes,
+		            fragmentation=free_list_bytes / (used_bytes + free_list_bytes) if used_bytes + free_list_bytes else 0.0,
+		            classes=classes)
+
+############################################### Shared Pickle ###############################################
+
+class SharedBlock:
+	# a SharedMemory segment with a semaphore used as its reference count, the last release removes both
+	def __init__(self, size=0, ids=None, readonly=False):
+		if ids is None:
+			self.shm = SharedMemory(IPC_PRIVATE, size, IPC_CREAT)
+			self.sem = Semaphore(IPC_PRIVATE, IPC_CREAT, initial_value=1)
+		else:
+			self.shm = SharedMemory(ids[0], not_key=True)
+			self.sem = Semaphore(ids[1], not_key=True)
+		self.shm.attach(readonly)
+		self.buffer = self.shm.as_buffer()
+		self.address = self.shm.address
+		if ids is None:
+			_blocks[self.address] = self
+	
+	@property
+	def ids(self):
+		return (self.shm.id, self.sem.id)
+	
+	def addref(self, n=1):
+		if n > 0:
+			self.sem._op(n, block=False, undo=False)
+	
+	# both decide atomically: the last reference drops 1 to 0, any other one drops n >= 2 by one
+	LAST_REF = ((0, -1, IPC_NOWAIT), (0, 0, IPC_NOWAIT))
+	OTHER_REF = ((0, -2, IPC_NOWAIT), (0, 1, IPC_NOWAIT))
+	
+	def release(self):
+		self.buffer = None
+		try:
+			self.shm.detach()
+		except BufferError:
+			self.buffer = self.shm.as_buffer()
+			raise
+		_blocks.pop(self.address, None)
+		try:
+			while True:
+				try:
+					BaseSemaphore._op(self.sem, self.LAST_REF)
+					break
+				except BlockingIOError:
+					pass
+				try:
+					BaseSemaphore._op(self.sem, self.OTHER_REF)
+					return
+				except BlockingIOError:
+					pass
+		except OSError as e:
+			# EINVAL/EIDRM: another reader removed the block already
+			if e.errno in (errno.EINVAL, errno.EIDRM):
+				return
+			raise
+		try:
+			self.shm.remove()
+			self.sem.remove()
+		except OSError:
+			pass
+
+_blocks = {}
+
+def shared_buffer(nbytes):
+	# a writable buffer in shared memory, objects built on it (e.g. numpy.frombuffer) are sent without copy;
+	# call .release() on the returned block when the sender no longer needs it
+	return SharedBlock(nbytes)
+
+def _find_block(view):
+	if view.readonly:
+		return None, 0
+	address = ctypes.addressof(ctypes.c_char.from_buffer(view))
+	for start, block in _blocks.items():
+		if start <= address and address + len(view) <= start + len(block.buffer):
+			return block, address - start
+	return None, 0
+
+def dumps(obj, readers=1):
+	# pickle protocol 5 with out-of-band buffers in shared memory, returns the small metadata bytes
+	buffers = []
+	data = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+	refs, copies, copy_size, shared = [], [], 0, {}
+	for pb in buffers:
+		view = pb.raw()
+		block, offset = _find_block(view) if len(view) else (None, 0)
+		if block is not None:
+			# Received releases each block once, so one reference per distinct block and reader
+			shared[block.ids] = block
+			refs.append((block.ids, offset, len(view)))
+		else:
+			refs.append((None, copy_size, len(view)))
+			copies.append((copy_size, view))
+			copy_size += (len(view) + 63) // 64 * 64
+	for block in shared.values():
+		block.addref(readers)
+	if copies:
+		block = SharedBlock(copy_size)
+		for offset, view in copies:
+			block.buffer[offset:offset+len(view)] = view
+		block.addref(readers - 1)
+		block_ids = block.ids
+		_blocks.pop(block.address, None)
+		block.buffer = None
+		block.shm.detach()
+		refs = [(ids or block_ids, offset, size) for ids, offset, size in refs]
+	return pickle.dumps((data, refs), protocol=5)
+
+class Received:
+	# the unpickled object and the shared blocks backing its buffers, release() after the last use
+	def __init__(self, metadata, readonly=False):
+		data, refs = pickle.loads(metadata)
+		self.blocks, views = {}, []
+		for ids, offset, size in refs:
+			ids = tuple(ids)
+			if ids not in self.blocks:
+				self.blocks[ids] = SharedBlock(ids=ids, readonly=readonly)
+			views.append(self.blocks[ids].buffer[offset:offset+size])
+		self.obj = pickle.loads(data, buffers=views)
+	
+	def release(self):
+		# BufferError while the caller still holds views, already released blocks are not retried
+		self.obj = None
+		for ids in list(self.blocks):
+			self.blocks[ids].release()
+			del self.blocks[ids]
+	
+	def __enter__(self):
+		return self.obj
+	
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.release()
+
+def loads(metadata, readonly=False):
+	return Received(metadata, readonly)
+
+def send_object(queue, obj, block=True, type=1):
+	queue.send(dumps(obj), block, type)
+
+def receive_object(queue, block=True, type=0):
+	message = queue.receive(block, type)
+	return None if message is None else Received(message[0])
+
+################################################## asyncio ##################################################
+# asyncio is imported where it is used, a running event loop means it is loaded already
+
+
+class IPCPoller:
+	# SysV queues and semaphores have no file descriptor, so one helper thread sweeps every pending
+	# operation with IPC_NOWAIT each round and wakes the awaiting event loops through
+	# call_soon_threadsafe (the loop's self-pipe). Rounds without progress back off from min_interval
+	# to max_interval, an idle poller sleeps. Wake-up latency stays within max_interval plus one sweep
+	# however many waiters are pending, at the cost of one system call per waiter per round.
+	PENDING = object()
+	
+	def __init__(self, min_interval=0.0005, max_interval=0.01):
+		self.min_interval, self.max_interval = min_interval, max_interval
+		self._waiters, self._lock = [], threading.Lock()
+		self._wakeup = threading.Event()
+		self._thread = None
+	
+	def submit(self, attempt, undo=None, loop=None):
+		# attempt() must not block and returns PENDING while it would; undo(result) reverts a result
+		# nobody awaits anymore, it runs on a thread of its own and may block
+		import asyncio
+		loop = loop or asyncio.get_running_loop()
+		future = loop.create_future()
+		with self._lock:
+			self._waiters.append((future, loop, attempt, undo))
+			if self._thread is None or not self._thread.is_alive():
+				self._thread = threading.Thread(target=self.__run, daemon=True)
+				self._thread.start()
+		self._wakeup.set()
+		return future
+	
+	def __len__(self):
+		return len(self._waiters)
+	
+	def __resolve(self, future, loop, undo, result, error):
+		if future.cancelled():
+			if error is None and callable(undo):
+				self.__undo(loop, undo, result)
+		elif error is not None:
+			future.set_exception(error)
+		else:
+			future.set_result(result)
+	
+	@staticmethod
+	def __undo(loop, undo, result):
+		def revert():
+			try:
+				undo(result)
+			except Exception as e:
+				# an undo that fails loses the result, tell the loop's exception handler instead of dropping it
+				if not loop.is_closed():
+					loop.call_soon_threadsafe(loop.call_exception_handler,
+					                          dict(message='IPCPoller: can not undo a cancelled operation', exception=e))
+		threading.Thread(target=revert, daemon=True).start()
+	
+	def __run(self):
+		interval = self.min_interval
+		while True:
+			with self._lock:
+				waiters = list(self._waiters)
+			if not waiters:
+				self._wakeup.wait()
+				self._wakeup.clear()
+				continue
+			progress, done = False, []
+			for waiter in waiters:
+				future, loop, attempt, undo = waiter
+				if future.done() or loop.is_closed():
+					done.append(waiter)
+					continue
+				try:
+					result, error = attempt(), None
+				except Exception as e:
+					result, error = None, e
+				if result is self.PENDING:
+					continue
+				progress = True
+				done.append(waiter)
+				try:
+					loop.call_soon_threadsafe(self.__resolve, future, loop, undo, result, error)
+				except RuntimeError:
+					# the loop closed while the attempt ran
+					if error is None and callable(undo):
+						self.__undo(loop, undo, result)
+			if done:
+				with self._lock:
+					for waiter in done:
+						self._waiters.remove(waiter)
+			interval = self.min_interval if progress else min(interval * 2, self.max_interval)
+			if self._wakeup.wait(interval):
+				self._wakeup.clear()
+				interval = self.min_interval
+
+_poller = None
+
+def get_poller():
+	global _poller
+	if _poller is None:
+		_poller = IPCPoller()
+	return _poller
+
+class AsyncMessageQueue:
+	def __init__(self, queue, poller=None):
+		self.queue, self.poller = queue, poller or get_poller()
+	
+	async def receive(self, type=0, timeout=None):
+		message = self.queue.receive(False, type)
+		if message is not None:
+			return message
+		def attempt():
+			message = self.queue.receive(False, type)
+			return IPCPoller.PENDING if message is None else message
+		def undo(message):
+			# blocks until the queue has room again, so the message is not lost to IPC_NOWAIT
+			self.queue.send(message[0], True, message[1])
+		import asyncio
+		return await asyncio.wait_for(self.poller.submit(attempt, undo), timeout)
+	
+	async def send(self, message, type=1, timeout=None):
+		def attempt():
+			try:
+				self.queue.send(message, False, type)
+			except BlockingIOError:
+				return IPCPoller.PENDING
+		if attempt() is not IPCPoller.PENDING:
+			return
+		import asyncio
+		await asyncio.wait_for(self.poller.submit(attempt), timeout)
+
+class AsyncSemaphore:
+	def __init__(self, semaphore, poller=None):
+		self.semaphore, self.poller = semaphore, poller or get_poller()
+	
+	async def acquire(self, delta=1, undo=True, timeout=None):
+		assert(delta > 0)
+		def attempt():
+			try:
+				self.semaphore.acquire(delta, False, undo)
+			except BlockingIOError:
+				return IPCPoller.PENDING
+		def revert(result):
+			self.semaphore.release(delta, undo)
+		if attempt() is not IPCPoller.PENDING:
+			return
+		import asyncio
+		await asyncio.wait_for(self.poller.submit(attempt, revert), timeout)
+	
+	def release(self, delta=1):
+		self.semaphore.release(delta)
+	
+	async def __aenter__(self):
+		await self.acquire()
+		return self
+	
+	async def __aexit__(self, exc_type, exc_val, exc_tb):
+		self.release()
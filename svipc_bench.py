@@ -0,0 +1,356 @@
+import time, json, argparse, os, socket, ctypes, multiprocessing
+from multiprocessing import shared_memory
+import capi, svipc
+
+_mp = multiprocessing.get_context('fork')
+
+
+def _percentiles(samples):
+	samples = sorted(samples)
+	at = lambda q: samples[min(int(q * len(samples)), len(samples) - 1)] * 1e6
+	return dict(p50_us=round(at(0.5), 2), p90_us=round(at(0.9), 2), p99_us=round(at(0.99), 2),
+	            max_us=round(samples[-1] * 1e6, 2))
+
+def _result(bench, name, n, elapsed, **kws):
+	return dict(kws, bench=bench, transport=name, ops=n, seconds=round(elapsed, 4),
+	            ops_per_sec=round(n / elapsed) if elapsed else 0)
+
+
+# every channel is created before fork and used as send(bytes)/receive()->bytes in the children
+
+class _MessageQueueChannel:
+	def __init__(self, size, block=True):
+		self.queue = svipc.MessageQueue(svipc.IPC_PRIVATE, svipc.IPC_CREAT, max_message_size=max(size, 1))
+		self.block = block
+	
+	def send(self, message):
+		while True:
+			try:
+				return self.queue.send(message, self.block)
+			except BlockingIOError:
+				os.sched_yield()
+	
+	def receive(self):
+		while True:
+			message = self.queue.receive(self.block)
+			if message is not None:
+				return message[0]
+			os.sched_yield()
+	
+	def close(self):
+		self.queue.remove()
+
+class _RingBufferChannel:
+	def __init__(self, size, spsc=False):
+		block = 64 if size <= 1024 else 256
+		self.ring = svipc.RingBuffer(svipc.IPC_PRIVATE, block * 16384, svipc.IPC_CREAT, block=block, spsc=spsc)
+		self.send, self.receive = self.ring.push, self.ring.pop
+	
+	def close(self):
+		self.ring.remove()
+
+class _QueueChannel:
+	def __init__(self, size):
+		self.queue = _mp.Queue()
+		self.send, self.receive = self.queue.put, self.queue.get
+	
+	def close(self):
+		self.queue.close()
+
+class _PipeChannel:
+	def __init__(self, size):
+		self.reader, self.writer = _mp.Pipe(duplex=False)
+		self.send, self.receive = self.writer.send_bytes, self.reader.recv_bytes
+	
+	def close(self):
+		self.reader.close()
+		self.writer.close()
+
+class _SocketChannel:
+	# SOCK_SEQPACKET keeps message boundaries, so no framing is needed
+	def __init__(self, size):
+		self.reader, self.writer = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+		self.size = max(size, 1)
+		for sock in (self.reader, self.writer):
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, max(self.size * 4, 65536))
+			sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, max(self.size * 4, 65536))
+	
+	def send(self, message):
+		self.writer.send(message)
+	
+	def receive(self):
+		return self.reader.recv(self.size)
+	
+	def close(self):
+		self.reader.close()
+		self.writer.close()
+
+CHANNELS = {
+	'svipc.MessageQueue': lambda size: _MessageQueueChannel(size),
+	'svipc.MessageQueue.nowait': lambda size: _MessageQueueChannel(size, block=False),
+	'svipc.RingBuffer': _RingBufferChannel,
+	'svipc.RingBuffer.spsc': lambda size: _RingBufferChannel(size, spsc=True),
+	'multiprocessing.Queue': _QueueChannel,
+	'multiprocessing.Pipe': _PipeChannel,
+	'socketpair.SEQPACKET': _SocketChannel,
+}
+# pipes, sockets and a single-producer/single-consumer ring have no safe many-to-many message semantics
+SINGLE = ('multiprocessing.Pipe', 'socketpair.SEQPACKET', 'svipc.RingBuffer.spsc')
+
+
+def _produce(channel, n, size):
+	message = b'x' * size
+	for i in range(n):
+		channel.send(message)
+
+def _consume(channel, done):
+	n = 0
+	while channel.receive() != b'':
+		n += 1
+	done.put(n)
+
+def bench_throughput(name, n, size, producers=1, consumers=1):
+	channel = CHANNELS[name](size)
+	done = _mp.Queue()
+	try:
+		workers = [_mp.Process(target=_consume, args=(channel, done)) for i in range(consumers)]
+		begin = time.time()
+		for worker in workers:
+			worker.start()
+		senders = [_mp.Process(target=_produce, args=(channel, n // producers, max(size, 1))) for i in range(producers)]
+		for sender in senders:
+			sender.start()
+		for sender in senders:
+			sender.join()
+		for i in range(consumers):
+			channel.send(b'')
+		received = sum(done.get() for i in range(consumers))
+		elapsed = time.time() - begin
+		for worker in workers:
+			worker.join()
+	finally:
+		channel.close()
+	return _result('throughput', name, received, elapsed, size=size, producers=producers, consumers=consumers,
+	               mb_per_sec=round(received * size / elapsed / 1e6, 2) if elapsed else 0)
+
+def _echo(request, reply):
+	while True:
+		message = request.receive()
+		reply.send(message)
+		if message == b'':
+			break
+
+def bench_latency(name, n, size):
+	# round trip of one message through two channels
+	request, reply = CHANNELS[name](size), CHANNELS[name](size)
+	try:
+		worker = _mp.Process(target=_echo, args=(request, reply))
+		worker.start()
+		message, samples = b'x' * max(size, 1), []
+		for i in range(n):
+			begin = time.perf_counter()
+			request.send(message)
+			reply.receive()
+			samples.append(time.perf_counter() - begin)
+		request.send(b'')
+		reply.receive()
+		worker.join()
+	finally:
+		request.close()
+		reply.close()
+	return dict(_result('latency', name, n, sum(samples), size=size), **_percentiles(samples))
+
+
+def bench_shared_memory(size, repeat):
+	data = bytearray(b'x' * size)
+	out = bytearray(size)
+	results = []
+	
+	shm = svipc.SharedMemory(svipc.IPC_PRIVATE, size, svipc.IPC_CREAT)
+	shm.attach()
+	try:
+		for mode in ('write/read', 'view', 'readinto'):
+			begin = time.time()
+			for i in range(repeat):
+				if mode == 'write/read':
+					shm.write(data)
+					shm.read(size)
+				elif mode == 'view':
+					view = shm.view(0, size)
+					view[:] = data
+					out[:] = view
+					view.release()
+				else:
+					shm.write(data)
+					shm.readinto(out)
+			elapsed = time.time() - begin
+			results.append(_result('shared_memory', 'svipc.SharedMemory.' + mode, repeat, elapsed, size=size,
+			                       mb_per_sec=round(2 * size * repeat / elapsed / 1e6, 2) if elapsed else 0))
+	finally:
+		shm.detach()
+		shm.remove()
+	
+	shm = shared_memory.SharedMemory(create=True, size=size)
+	try:
+		begin = time.time()
+		for i in range(repeat):
+			shm.buf[:size] = data
+			out[:] = shm.buf[:size]
+		elapsed = time.time() - begin
+		results.append(_result('shared_memory', 'multiprocessing.shared_memory', repeat, elapsed, size=size,
+		                       mb_per_sec=round(2 * size * repeat / elapsed / 1e6, 2) if elapsed else 0))
+	finally:
+		shm.close()
+		shm.unlink()
+	return results
+
+
+def _pong(ping, pong, n, **kws):
+	# no SEM_UNDO: the exit adjustment of the worker would take back its last release
+	for i in range(n):
+		ping.acquire(**kws)
+		pong.release(**kws)
+
+def bench_semaphore(n):
+	results = []
+	for name in ('svipc.Semaphore', 'multiprocessing.Semaphore'):
+		if name == 'svipc.Semaphore':
+			ping = svipc.Semaphore(svipc.IPC_PRIVATE, svipc.IPC_CREAT)
+			pong = svipc.Semaphore(svipc.IPC_PRIVATE, svipc.IPC_CREAT)
+		else:
+			ping, pong = _mp.Semaphore(0), _mp.Semaphore(0)
+		kws = dict(undo=False) if name == 'svipc.Semaphore' else {}
+		try:
+			worker = _mp.Process(target=_pong, args=(ping, pong, n), kwargs=kws)
+			worker.start()
+			samples = []
+			for i in range(n):
+				begin = time.perf_counter()
+				ping.release(**kws)
+				pong.acquire(**kws)
+				samples.append(time.perf_counter() - begin)
+			worker.join()
+			results.append(dict(_result('semaphore_pingpong', name, n, sum(samples)), **_percentiles(samples)))
+		finally:
+			if name == 'svipc.Semaphore':
+				ping.remove()
+				pong.remove()
+	
+	for name in ('svipc.Semaphore', 'svipc.Lock', 'multiprocessing.Lock'):
+		if name == 'svipc.Semaphore':
+			lock = svipc.Semaphore(svipc.IPC_PRIVATE, svipc.IPC_CREAT, initial_value=1)
+		elif name == 'svipc.Lock':
+			lock = svipc.Lock(svipc.IPC_PRIVATE, svipc.IPC_CREAT)
+		else:
+			lock = _mp.Lock()
+		begin = time.time()
+		for i in range(n):
+			lock.acquire()
+			lock.release()
+		elapsed = time.time() - begin
+		if name.startswith('svipc'):
+			lock.remove()
+		results.append(_result('uncontended_lock', name, n, elapsed))
+	return results
+
+
+def bench_call_overhead(n):
+	# cost per call of the ctypes layer, from the full svipc path down to a bare C call
+	sem = svipc.BaseSemaphore(svipc.IPC_PRIVATE, 1, svipc.IPC_CREAT, initial_value=1)
+	up, down = sem.prepare([(0, 1, 0)]), sem.prepare([(0, -1, 0)])
+	raw_semop = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_int, ctypes.POINTER(svipc.sembuf), ctypes.c_uint)(('semop', capi.libc))
+	raw_getpid = ctypes.CFUNCTYPE(ctypes.c_int)(('getpid', capi.libc))
+	semop = capi.cfunc('semop', 'int', ('semid', 'int'), ('sops', ctypes.POINTER(svipc.sembuf)), ('nsops', 'u_int'))
+	pair = capi.batch(svipc.semop, [(sem.id, up, 1), (sem.id, down, 1)])
+	calls = [
+		('BaseSemaphore._op(list)', lambda: sem._op([(0, 1, 0)]) or sem._op([(0, -1, 0)])),
+		('BaseSemaphore._op(prepared)', lambda: sem._op(up) or sem._op(down)),
+		('capi.cfunc(paramflags+errcheck)', lambda: semop(sem.id, up, 1) or semop(sem.id, down, 1)),
+		('capi.cfunc(fast+errcheck)', lambda: svipc.semop(sem.id, up, 1) or svipc.semop(sem.id, down, 1)),
+		('capi.batch(fast+errcheck)', lambda: pair()),
+		('libc.semop(argtypes)', lambda: raw_semop(sem.id, up, 1) or raw_semop(sem.id, down, 1)),
+		('libc.getpid', lambda: raw_getpid() and raw_getpid()),
+		('os.getpid', lambda: os.getpid() and os.getpid()),
+	]
+	results = []
+	try:
+		for name, call in calls:
+			begin = time.perf_counter()
+			for i in range(n):
+				call()
+			elapsed = time.perf_counter() - begin
+			results.append(dict(_result('call_overhead', name, 2 * n, elapsed), ns_per_call=round(elapsed / (2 * n) * 1e9, 1)))
+	finally:
+		sem.remove()
+	return results
+
+
+def bench_async_wakeup(waiters=200, rounds=50):
+	# latency from a send to the wake-up of the one receiver it targets, while `waiters` other
+	# AsyncMessageQueue.receive() calls stay pending on the same IPCPoller
+	import asyncio
+	queues = [svipc.MessageQueue(svipc.IPC_PRIVATE, svipc.IPC_CREAT) for _ in range(waiters)]
+	async def measure():
+		channels = [svipc.AsyncMessageQueue(q) for q in queues]
+		pending = [asyncio.ensure_future(channel.receive()) for channel in channels]
+		await asyncio.sleep(0.1)
+		samples = []
+		for i in range(rounds):
+			target = i * 7919 % waiters
+			begin = time.perf_counter()
+			queues[target].send(b'wake')
+			await pending[target]
+			samples.append(time.perf_counter() - begin)
+			pending[target] = asyncio.ensure_future(channels[target].receive())
+			await asyncio.sleep(0.005)
+		for future in pending:
+			future.cancel()
+		await asyncio.gather(*pending, return_exceptions=True)
+		return samples
+	try:
+		samples = asyncio.run(measure())
+	finally:
+		for q in queues:
+			q.remove()
+	return [dict(_result('async_wakeup', 'svipc.AsyncMessageQueue', rounds, sum(samples), waiters=waiters),
+	             **_percentiles(samples))]
+
+
+def run(n=20000, sizes=(64, 1024, 8000), workers=((1, 1), (2, 2), (4, 1)), channels=None, **kws):
+	results = []
+	channels = channels or list(CHANNELS)
+	for size in sizes:
+		for name in channels:
+			for producers, consumers in workers:
+				if name in SINGLE and (producers, consumers) != (1, 1):
+					continue
+				results.append(bench_throughput(name, n, size, producers, consumers))
+			results.append(bench_latency(name, max(n // 10, 100), size))
+	for size in kws.get('shm_sizes', (4096, 1 << 20, 64 << 20)):
+		results += bench_shared_memory(size, max(1, min(n, (256 << 20) // size)))
+	results += bench_semaphore(n)
+	results += bench_call_overhead(n)
+	results += bench_async_wakeup(kws.get('waiters', 200))
+	return results
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Compare svipc primitives with multiprocessing, pipes and Unix sockets')
+	parser.add_argument('-n', type=int, default=20000, help='messages or operations per run')
+	parser.add_argument('--size', type=int, nargs='+', default=[64, 1024, 8000], help='message sizes in bytes')
+	parser.add_argument('--workers', nargs='+', default=['1x1', '2x2', '4x1'], help='producers x consumers')
+	parser.add_argument('--channel', nargs='+', choices=list(CHANNELS), help='transports to run, default all')
+	parser.add_argument('--shm-size', type=int, nargs='+', default=[4096, 1 << 20, 64 << 20])
+	parser.add_argument('--waiters', type=int, default=200, help='pending async receivers in the wake-up bench')
+	parser.add_argument('--json', action='store_true', help='print results as json')
+	args = parser.parse_args()
+	
+	workers = [tuple(int(x) for x in w.split('x')) for w in args.workers]
+	results = run(args.n, args.size, workers, args.channel, shm_sizes=args.shm_size, waiters=args.waiters)
+	if args.json:
+		print(json.dumps(results, indent=2))
+	else:
+		for r in results:
+			extra = ' '.join('%s=%s'%(k, r[k]) for k in ('size', 'producers', 'consumers', 'waiters') if k in r)
+			detail = ' '.join('%s=%s'%(k, r[k]) for k in ('mb_per_sec', 'p50_us', 'p99_us', 'ns_per_call') if k in r)
+			print('%-18s %-36s %-30s %10d ops/s %s'%(r['bench'], r['transport'], extra, r['ops_per_sec'], detail))
@@ -1,68 +1,455 @@
-import socket, select, http.client
-import time, os, sys, queue, json
+import socket, select, http.client, array
+import time, os, sys, queue, json, threading, random, functools, gzip, math, weakref, atexit
+import asyncio, codecs, re
+from collections import OrderedDict
+from multiprocessing.dummy import Pool as ThreadPool
+from collections import deque
+import FileMessageQueue
+
+
+@functools.lru_cache(maxsize=65536)
+def _series_prefix(metric, tags):
+	return '{"metric": %s, "tags": %s, "timestamp": '%(json.dumps(metric), json.dumps(dict(tags)))
+
+def _series_tags(tags):
+	return tuple(sorted((k,v) for k,v in tags.items() if v not in (None,'')))
+
+def _check_columns(timestamps, values):
+	# zip() would silently drop the tail of the longer column
+	if timestamps is not None and len(timestamps) != len(values):
+		raise ValueError('timestamps and values differ in length (%d != %d)'%(len(timestamps), len(values)))
+
+def _encode_points(metric, timestamps, values, tags):
+	_check_columns(timestamps, values)
+	prefix = _series_prefix(metric, _series_tags(tags))
+	now = int(time.time())
+	if timestamps is None:
+		timestamps = [now] * len(values)
+	return [str.format('{}{}, "value": {}}}', prefix, int(timestamp or now),
+	                   value if type(value) in (int, float) else json.dumps(value))
+	        for timestamp, value in zip(timestamps, values)]
+
+
+def _query_data(metric, start, end=None, tags={}, aggregator='avg', downsample=None):
+	return _query_many_data([dict(metric=metric, tags=tags, aggregator=aggregator, downsample=downsample)], start, end)
+
+def _query_many_data(queries, start, end=None):
+	# queries: metric names or dicts of metric, tags, aggregator and downsample
+	sub_queries = []
+	for q in queries:
+		if isinstance(q, str): q = dict(metric=q)
+		sub_queries.append({
+			"aggregator": q.get('aggregator', 'avg'),
+			"downsample": q.get('downsample'),
+			"metric": q['metric'],
+			"tags": q.get('tags', {})
+		})
+	return {
+		"start": start,
+		"end": end,
+		"noAnnotations": True,
+		"queries": sub_queries
+	}
+
+def _iter_json_array(read, size=65536):
+	# yield the elements of a JSON array read incrementally by read(n), one element decoded at a time
+	decoder, buf, pos, eof = json.JSONDecoder(), '', 0, False
+	tail = codecs.getincrementaldecoder('utf-8')()
+	def fill(n):
+		nonlocal buf, pos, eof
+		data = read(n)
+		eof = not data
+		buf = buf[pos:] + tail.decode(data or b'', final=eof)
+		pos = 0
+	
+	fill(size)
+	pos = WHITESPACE.match(buf, pos).end()
+	if buf[pos:pos+1] != '[':
+		raise ValueError('Expecting JSON array')
+	pos += 1
+	want = size
+	while True:
+		pos = WHITESPACE.match(buf, pos).end()
+		if pos >= len(buf):
+			if eof: raise ValueError('JSON array unclosed')
+			fill(want)
+			continue
+		if buf[pos] == ']':
+			return
+		if buf[pos] == ',':
+			pos += 1
+			continue
+		try:
+			obj, end = decoder.raw_decode(buf, pos)
+			if end == len(buf) and not eof and not isinstance(obj, (dict, list)):
+				raise json.JSONDecodeError('Scalar may continue', buf, end)
+		except json.JSONDecodeError:
+			if eof: raise
+			# an element is larger than the buffer, grow reads geometrically to stay linear
+			want *= 2
+			fill(want)
+			continue
+		pos, want = end, size
+		yield obj
+
+WHITESPACE = re.compile(r'\s*')
+
+def _query_result(status, reply):
+	if not reply: return reply
+	if status != 200:
+		error = reply['error']
+		return {'error':{'code':error['code'], 'message':error['message']}}
+	dps = [(int(timestamp), value) for timestamp, value in reply[0]['dps'].items()]
+	dps.sort()
+	return dps
+
+
+class Deadband:
+	# drops points whose value moved no more than `deadband` (a fraction of the last value if relative)
+	# since the last point sent for the series, but always sends one every `heartbeat` seconds.
+	# Per-series state is two array slots indexed by the hash of (metric, tags).
+	def __init__(self, deadband=0.0, heartbeat=600, relative=False):
+		self.deadband, self.heartbeat, self.relative = deadband, heartbeat, relative
+		self._index = {}
+		self._values = array.array('d')
+		self._times = array.array('q')
+		self.dropped = 0
+	
+	def __len__(self):
+		return len(self._index)
+	
+	def filter(self, metric, timestamps, values, tags):
+		_check_columns(timestamps, values)
+		key, now = hash((metric, _series_tags(tags))), int(time.time())
+		if timestamps is None:
+			timestamps = [now] * len(values)
+		index = self._index.get(key)
+		kept_timestamps, kept_values = [], []
+		for timestamp, value in zip(timestamps, values):
+			timestamp = int(timestamp or now)
+			if type(value) not in (int, float):
+				kept_timestamps.append(timestamp)
+				kept_values.append(value)
+				continue
+			if index is None:
+				index = self._index[key] = len(self._values)
+				self._values.append(value)
+				self._times.append(timestamp)
+			else:
+				last = self._values[index]
+				band = self.deadband * abs(last) if self.relative else self.deadband
+				if abs(value - last) <= band and timestamp - self._times[index] < self.heartbeat:
+					self.dropped += 1
+					continue
+				self._values[index] = value
+				self._times[index] = timestamp
+			kept_timestamps.append(timestamp)
+			kept_values.append(value)
+		return kept_timestamps, kept_values
 
 
 class Connection:
-	def __init__(self, host='localhost', port=4242, timeout=2.0):
+	def __init__(self, host='localhost', port=4242, timeout=2.0, **kws):
 		self.address = (host, port)
 		self.timeout = timeout
 		self.sock = None
+		self.buffer_size = kws.get('buffer_size', 65536)
+		self.flush_interval = kws.get('flush_interval', 1.0)
+		self.retries = kws.get('retries', 1)
+		# callback function: self.error_callback(line), error replies are kept in self.errors otherwise
+		self.error_callback = kws.get('error_callback')
+		self.errors = deque(maxlen=kws.get('max_errors', 1000))
+		self._lines, self._length, self._last_flush = [], 0, time.time()
+		self._lock = threading.RLock()
+		self._stopped = threading.Event()
 		self.connect()
+		# the time threshold is kept by its own thread, so it outlives a socket dropped by the peer
+		flusher = threading.Thread(target=Connection.__flusher, args=(weakref.ref(self), self._stopped), daemon=True)
+		flusher.start()
 	
 	def connect(self):
-		if not self.sock:
-			self.sock = socket.socket()
-		try:
-			self.sock.settimeout(self.timeout)
-			self.sock.connect(self.address)
-		except:
-			self.close()
-			raise
+		with self._lock:
+			if self.sock: return
+			sock = socket.socket()
+			try:
+				sock.settimeout(self.timeout)
+				sock.connect(self.address)
+			except:
+				sock.close()
+				raise
+			self.sock = sock
+			reader = threading.Thread(target=self.__reader, args=(sock,), daemon=True)
+			reader.start()
+	
+	def _close_socket(self, sock=None):
+		with self._lock:
+			if self.sock and (sock is None or sock is self.sock):
+				self.sock.close()
+				self.sock = None
 	
 	def close(self):
-		if self.sock:
-			self.sock.close()
-			self.sock = None
+		self._stopped.set()
+		try:
+			self.flush()
+		finally:
+			self._close_socket()
 	
 	@property
 	def closed(self):
 		return (self.sock is None)
 	
+	def __len__(self):
+		return len(self._lines)
+	
 	def put(self, metric, timestamp, value, **kws):
 		float(value)
-		if not tags:
+		tagvals = ' '.join(['{}={}'.format(k,v) for k,v in kws.items() if v not in (None,'')])
+		if not tagvals:
 			raise ValueError('Missing tags')
-		if self.closed:
-			self.connect()
-		
 		if not timestamp: timestamp = time.time()
-		tagvals = ' '.join(['{}={}'.format(k,v) for k,v in kws.items() if v not in (None,'')])
-		line = str.format('put {} {} {} {}\n', metric, int(timestamp), value, tagvals)
-		msg = line.encode('latin-1')
+		line = str.format('put {} {} {} {}\n', metric, int(timestamp), value, tagvals).encode('latin-1')
+		with self._lock:
+			self._lines.append(line)
+			self._length += len(line)
+			if self._length >= self.buffer_size:
+				self.flush()
+	
+	def flush(self):
+		with self._lock:
+			if not self._lines: return
+			data = b''.join(self._lines)
+			self._lines, self._length = [], 0
+			self._last_flush = time.time()
+			for retry in range(self.retries+1):
+				try:
+					if self.closed:
+						self.connect()
+					self.sock.sendall(data)
+					return
+				except OSError:
+					self._close_socket()
+					if retry >= self.retries:
+						self._lines.insert(0, data)
+						self._length += len(data)
+						raise
+	
+	def __reader(self, sock):
+		pending = b''
+		while self.sock is sock:
+			try:
+				if select.select([sock], [], [], 0.1)[0]:
+					data = sock.recv(4096)
+					if not data:
+						self._close_socket(sock)
+						break
+					*lines, pending = (pending + data).split(b'\n')
+					for line in lines:
+						self.__on_error(line.decode('latin-1').strip())
+			except (OSError, ValueError):
+				self._close_socket(sock)
+				break
+	
+	@staticmethod
+	def __flusher(ref, stopped):
+		while True:
+			self = ref()
+			if self is None: return
+			interval = self.flush_interval
+			if self._lines and time.time() - self._last_flush >= interval:
+				try:
+					# reconnects if the peer closed the socket, the lines stay buffered on failure
+					self.flush()
+				except OSError:
+					pass
+			del self
+			if stopped.wait(min(interval, 0.1)):
+				return
+	
+	def __on_error(self, line):
+		if not line: return
+		if callable(self.error_callback):
+			try:
+				self.error_callback(line)
+			except:
+				pass
+		else:
+			self.errors.append(line)
+
+
+class ConnectionPool:
+	# keep-alive http.client connections shared by threads, a connection is used by one request at a time
+	def __init__(self, host='localhost', port=4242, timeout=2.0, maxsize=8):
+		self.host, self.port, self.timeout = host, port, timeout
+		self._idle = queue.LifoQueue(maxsize)
+	
+	def get(self):
 		try:
-			while select.select([self.sock.fileno()], [], [], 0)[0]:
-				if not self.sock.recv(2048):
-					raise BrokenPipeError(socket.errno.EPIPE, 'Connection closed by peer')
-			self.sock.send(msg)
-		except:
-			self.close()
-			raise
+			return self._idle.get_nowait()
+		except queue.Empty:
+			return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+	
+	def put(self, conn):
+		try:
+			self._idle.put_nowait(conn)
+		except queue.Full:
+			conn.close()
+	
+	def close(self):
+		while True:
+			try:
+				self._idle.get_nowait().close()
+			except queue.Empty:
+				break
+
+
+def _cache_options(kws, ttl='ttl'):
+	# MetadataCache options among a client's keywords, handed on to every HTTPConnection it opens
+	options = {k:kws[k] for k in ('negative_ttl', 'snapshot', 'snapshot_interval') if k in kws}
+	if ttl in kws:
+		options['ttl'] = kws[ttl]
+	return options
+
+class MetadataCache:
+	# thread-safe cache of server config, UIDs and suggest results shared by connections to one server,
+	# misses are cached for negative_ttl, and an optional json snapshot file gives a warm start
+	__caches, __lock = {}, threading.Lock()
+	TTL = dict(config=3600, metric=86400, tagk=86400, tagv=86400, suggest=60)
+	
+	@staticmethod
+	def get_cache(host, port, **kws):
+		with MetadataCache.__lock:
+			cache = MetadataCache.__caches.get((host, port))
+			if not cache:
+				cache = MetadataCache(**kws)
+				MetadataCache.__caches[(host, port)] = cache
+			elif kws:
+				# the cache is shared: one created with defaults (e.g. by TSDB internals) adopts the first
+				# explicit options, other callers can not silently get other options
+				wanted = MetadataCache.__options(**kws)
+				if any(wanted[k] != cache.__current()[k] for k in kws):
+					if not cache._defaults:
+						raise ValueError('metadata cache for %s:%s already exists with other options'%(host, port))
+					cache.__configure(**dict(cache.__current(), **kws))
+			return cache
+	
+	@staticmethod
+	def __options(ttl={}, negative_ttl=30, snapshot=None, snapshot_interval=60):
+		return dict(ttl=dict(MetadataCache.TTL, **ttl), negative_ttl=negative_ttl, snapshot=snapshot,
+		            snapshot_interval=snapshot_interval)
+	
+	def __init__(self, ttl={}, negative_ttl=30, snapshot=None, snapshot_interval=60):
+		self._entries, self._lock = {}, threading.Lock()
+		# None until the first save, so the first fill is written at once
+		self._saved, self._dirty, self._at_exit = None, False, False
+		self.__configure(ttl, negative_ttl, snapshot, snapshot_interval)
+	
+	def __current(self):
+		return MetadataCache.__options(self.ttl, self.negative_ttl, self.snapshot, self.snapshot_interval)
+	
+	def __configure(self, ttl={}, negative_ttl=30, snapshot=None, snapshot_interval=60):
+		self.ttl = dict(MetadataCache.TTL, **ttl)
+		self.negative_ttl = negative_ttl
+		self.snapshot, self.snapshot_interval = snapshot, snapshot_interval
+		self._defaults = self.__current() == MetadataCache.__options()
+		if snapshot:
+			if os.path.exists(snapshot):
+				self.load()
+				self._saved = time.time()
+			if not self._at_exit:
+				atexit.register(MetadataCache.__save_at_exit, weakref.ref(self))
+				self._at_exit = True
+			# entries filled before the snapshot was configured count as the first fill
+			if self._dirty and self._saved is None:
+				self.save()
+	
+	@staticmethod
+	def __save_at_exit(ref):
+		cache = ref()
+		if cache is not None:
+			try:
+				cache.flush()
+			except (OSError, TypeError, ValueError):
+				pass
+	
+	MISSING = object()
+	
+	def get(self, kind, key=None):
+		with self._lock:
+			entry = self._entries.get((kind, key))
+		if entry is None or entry[0] < time.time():
+			return MetadataCache.MISSING
+		return entry[1]
+	
+	def set(self, kind, key, value):
+		ttl = self.negative_ttl if value is None else self.ttl.get(kind, 60)
+		with self._lock:
+			self._entries[(kind, key)] = (time.time() + ttl, value)
+			self._dirty = True
+		if self.snapshot and (self._saved is None or time.time() - self._saved >= self.snapshot_interval):
+			self.save()
+	
+	def flush(self):
+		# write the snapshot if anything changed since the last save
+		if self.snapshot and self._dirty:
+			self.save()
+	
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+	
+	def load(self):
+		with open(self.snapshot) as fd:
+			entries = json.load(fd)
+		now = time.time()
+		with self._lock:
+			for kind, key, expires, value in entries:
+				if expires > now:
+					self._entries[(kind, tuple(key) if isinstance(key, list) else key)] = (expires, value)
+	
+	def save(self):
+		with self._lock:
+			entries = [(kind, key, expires, value) for (kind, key), (expires, value) in self._entries.items()]
+			self._saved, self._dirty = time.time(), False
+		tmp_file = '%s.%d.tmp'%(self.snapshot, os.getpid())
+		with open(tmp_file, 'w') as fd:
+			json.dump(entries, fd)
+		os.replace(tmp_file, self.snapshot)
 
 
 class HTTPConnection:
 	def __init__(self, host='localhost', port=4242, timeout=2.0, **kws):
-		self.http = http.client.HTTPConnection(host, port, timeout=timeout)
+		self.pool = kws.get('pool')
+		self.__own_pool = self.pool is None
+		if self.__own_pool:
+			self.pool = ConnectionPool(host, port, timeout, maxsize=1)
+		self.http = None
+		self.retries = kws.get('retries', 2)
+		self.backoff = kws.get('backoff', 0.1)
+		self.gzip = kws.get('gzip', True)
+		self.gzip_min = kws.get('gzip_min', 1024)
 		self.auto_commit = kws.get('auto_commit', False)
+		self.cache = kws.get('cache') or MetadataCache.get_cache(host, port, **_cache_options(kws))
+		self.deadband = None
+		if kws.get('deadband') is not None:
+			self.deadband = Deadband(kws['deadband'], kws.get('heartbeat', 600), kws.get('relative', False))
 		self.metrics, self.metrics_length = [], 0
 	
 	@property
 	def config(self):
-		if not hasattr(self, '__config'):
-			self.__config = self.request('GET', '/api/config')
-		return self.__config
+		config = self.cache.get('config')
+		if config is MetadataCache.MISSING:
+			config = self.request('GET', '/api/config')
+			if config and self.last_response['status'] == 200:
+				self.cache.set('config', None, config)
+		return config
 	
 	def close(self):
-		self.http.close()
+		if self.http:
+			self.http.close()
+			self.http = None
+		if self.__own_pool:
+			self.pool.close()
+		self.cache.flush()
 	
 	def onRequest(self, request, response):
 		res = None
@@ -78,21 +465,47 @@ class HTTPConnection:
 	
 	def _request(self, method, url, body=None):
 		self.last_request, self.last_response = dict(method=method, url=url, body=body), None
-		self.http.request(method, url, body, headers={"Content-Type":"application/json;charset=UTF-8"})
+		headers = {"Content-Type":"application/json;charset=UTF-8"}
+		if isinstance(body, str):
+			body = body.encode('utf-8')
+		if body and self.gzip and len(body) >= self.gzip_min:
+			body = gzip.compress(body, compresslevel=1)
+			headers["Content-Encoding"] = "gzip"
+		if self.http is None:
+			self.http = self.pool.get()
+		self.http.request(method, url, body, headers=headers)
 	
 	def get_response(self):
 		response = self.http.getresponse()
-		total_bytes = int(response.getheader('Content-Length'))
-		data = bytearray(total_bytes)
-		response.readinto(data)
-		reply = json.loads(data.decode('utf-8'))
+		content_length = response.getheader('Content-Length')
+		if content_length is None:
+			data = response.read()
+		else:
+			data = bytearray(int(content_length))
+			response.readinto(data)
+		reply = json.loads(data.decode('utf-8')) if data else None
 		self.last_response = dict(status=response.status, reason=response.reason, reply=reply)
+		if response.will_close:
+			self.http.close()
+		else:
+			self.pool.put(self.http)
+		self.http = None
 		return reply
 	
 	def request(self, method, url, body=None):
 		try:
-			self._request(method, url, body)
-			reply = self.get_response()
+			for retry in range(self.retries+1):
+				try:
+					self._request(method, url, body)
+					reply = self.get_response()
+					break
+				except (OSError, http.client.HTTPException):
+					if self.http:
+						self.http.close()
+						self.http = None
+					if retry >= self.retries:
+						raise
+					time.sleep(self.backoff * 2**retry * random.uniform(0.5, 1.5))
 			self.onRequest(self.last_request, self.last_response)
 			return reply
 		except:
@@ -101,17 +514,30 @@ class HTTPConnection:
 			return None
 	
 	def put(self, metric, timestamp, value, **kws):
+		return self.put_many(metric, (timestamp,), (value,), kws)
+	
+	def put_many(self, metric, timestamps, values, tags):
+		if self.deadband is not None:
+			timestamps, values = self.deadband.filter(metric, timestamps, values, tags)
+		return self._append(_encode_points(metric, timestamps, values, tags))
+	
+	def put_multi(self, series):
+		# series: iterable of (metric, timestamps, values, tags)
+		remain = None
+		for metric, timestamps, values, tags in series:
+			remain = self.put_many(metric, timestamps, values, tags)
+		return remain
+	
+	def _append(self, datapoints):
 		max_chunk = int(self.config['tsd.http.request.max_chunk'])
-		if not timestamp: timestamp = time.time()
-		tags = {k:v for k,v in kws.items() if v not in (None,'')}
-		datapoint = json.dumps(dict(metric=metric, timestamp=int(timestamp), value=value, tags=tags))
-		if len(datapoint)+self.metrics_length+2 > max_chunk:
-			if not self.auto_commit:
-				raise http.client.LineTooLong('Too long to send metrics')
-			self.commit()
-		
-		self.metrics.append(datapoint)
-		self.metrics_length += len(datapoint) + 2
+		for datapoint in datapoints:
+			if len(datapoint)+self.metrics_length+2 > max_chunk:
+				if not self.auto_commit:
+					raise http.client.LineTooLong('Too long to send metrics')
+				self.commit()
+			
+			self.metrics.append(datapoint)
+			self.metrics_length += len(datapoint) + 2
 		return (max_chunk - self.metrics_length)
 	
 	def len(self):
@@ -136,115 +562,666 @@ class HTTPConnection:
 		return self.request('POST', '/api/annotation', json.dumps(req_data))
 		
 	def query(self, metric, start, end=None, tags={}, aggregator='avg', downsample=None):
-		query_data = {
-			"start": start,
-			"end": end,
-			"noAnnotations": True,
-			"queries": [
-				{
-					"aggregator": aggregator,
-					"downsample": downsample,
-					"metric": metric,
-					"tags": tags
-				}
-			]
-		}
-		
+		query_data = _query_data(metric, start, end, tags, aggregator, downsample)
 		reply = self.request('POST', '/api/query', json.dumps(query_data))
-		if not reply: return reply
-		if self.last_response['status'] != 200:
-			error = reply['error']
-			return {'error':{'code':error['code'], 'message':error['message']}}
-		dps = [(int(timestamp), value) for timestamp, value in reply[0]['dps'].items()]
-		dps.sort()
-		return dps
+		return _query_result(self.last_response['status'] if reply else None, reply)
+	
+	def query_many(self, queries, start, end=None, columns=False):
+		return list(self.iter_query(queries, start, end, columns))
+	
+	def iter_query(self, queries, start, end=None, columns=False):
+		# yield each result series of one /api/query as it is decoded, with dps converted to a sorted list
+		# of (timestamp, value) or to (timestamps, values) arrays; an error reply is raised as HTTPException
+		body = json.dumps(_query_many_data(queries, start, end))
+		self._request('POST', '/api/query', body)
+		response = self.http.getresponse()
+		try:
+			if response.status != 200:
+				data = response.read()
+				reply = json.loads(data.decode('utf-8')) if data else {}
+				self.last_response = dict(status=response.status, reason=response.reason, reply=reply)
+				error = reply.get('error', {})
+				raise http.client.HTTPException('%d %s'%(error.get('code', response.status), error.get('message', response.reason)))
+			for series in _iter_json_array(response.read):
+				dps = sorted((int(timestamp), value) for timestamp, value in series['dps'].items())
+				if columns:
+					dps = array.array('q', [t for t, _ in dps]), array.array('d', [v for _, v in dps])
+				series['dps'] = dps
+				yield series
+			self.last_response = dict(status=response.status, reason=response.reason, reply=None)
+			if response.will_close:
+				self.http.close()
+			else:
+				self.pool.put(self.http)
+			self.http = None
+		finally:
+			if self.http:
+				self.http.close()
+				self.http = None
 	
 	def suggest(self, type, q=None, max=25):
 		assert(type in {'metrics', 'tagk', 'tagv'})
-		return self.request('POST', '/api/suggest', json.dumps({'type':type, 'q':q, 'max':max}))
+		reply = self.cache.get('suggest', (type, q, max))
+		if reply is MetadataCache.MISSING:
+			reply = self.request('POST', '/api/suggest', json.dumps({'type':type, 'q':q, 'max':max}))
+			if reply is not None and self.last_response['status'] == 200:
+				self.cache.set('suggest', (type, q, max), reply)
+		return reply
 	
 	def getuid(self, metrics=[], tagk=[], tagv=[]):
-		reply = self.request('POST', '/api/uid/assign', json.dumps({'metric':metrics, 'tagk':tagk, 'tagv':tagv}))
-		uids = dict(metric=reply['metric'], tagk=reply['tagk'], tagv=reply['tagv'])
-		metric_exists, tagk_exists, tagv_exists = reply.get('metric_errors',{}), reply.get('tagk_errors',{}), reply.get('tagv_errors',{})
-		for k,v in metric_exists.items():
-			if v.startswith('Name already exists with UID:'): uids['metric'][k] = v[-6:]
-		for k,v in tagk_exists.items():
-			if v.startswith('Name already exists with UID:'): uids['tagk'][k] = v[-6:]
-		for k,v in tagv_exists.items():
-			if v.startswith('Name already exists with UID:'): uids['tagv'][k] = v[-6:]
+		uids, missing = dict(metric={}, tagk={}, tagv={}), dict(metric=[], tagk=[], tagv=[])
+		for kind, names in (('metric', metrics), ('tagk', tagk), ('tagv', tagv)):
+			for name in names:
+				uid = self.cache.get(kind, name)
+				if uid is MetadataCache.MISSING:
+					missing[kind].append(name)
+				elif uid is not None:
+					uids[kind][name] = uid
+		if not any(missing.values()):
+			return uids
+		
+		reply = self.request('POST', '/api/uid/assign', json.dumps(missing))
+		for kind in ('metric', 'tagk', 'tagv'):
+			assigned = dict(reply.get(kind) or {})
+			for k,v in (reply.get(kind+'_errors') or {}).items():
+				if v.startswith('Name already exists with UID:'): assigned[k] = v[-6:]
+			uids[kind].update(assigned)
+			for name in missing[kind]:
+				self.cache.set(kind, name, assigned.get(name))
 		return uids
 
 
+class Spool:
+	# durable store for request bodies which could not be sent, replayed in the background.
+	# All FileMessageQueue access happens on the spool thread through metadata of its own, the cached
+	# one from get_metadata() is bound to whichever thread opened it first. A failure restarts the loop
+	# with backoff and is reported through error_callback(None, exc_info) and `errors`.
+	def __init__(self, path, host='localhost', port=4242, timeout=2.0, **kws):
+		self.path, self.address, self.timeout = path, (host, port), timeout
+		self.queue_name = kws.get('spool_queue', 'tsdb_spool')
+		self.backoff_min = kws.get('backoff_min', 1.0)
+		self.backoff_max = kws.get('backoff_max', 60.0)
+		self.rate = kws.get('replay_rate', 10.0)
+		self._callback = kws.get('callback')
+		self._error_callback = kws.get('error_callback')
+		self._options = {k:kws[k] for k in ('retries', 'backoff', 'gzip', 'gzip_min') if k in kws}
+		self._incoming, self._pending = queue.Queue(), []
+		self._terminated = threading.Event()
+		self.spooled, self.replayed, self.errors = 0, 0, 0
+		if not os.path.exists(path):
+			os.makedirs(path)
+		self._thread = threading.Thread(target=self.__run, daemon=True)
+		self._thread.start()
+	
+	def put(self, body):
+		self._incoming.put(body)
+	
+	def close(self):
+		self._terminated.set()
+		self._thread.join()
+	
+	def __report(self, body):
+		self.errors += 1
+		if callable(self._error_callback):
+			try:
+				self._error_callback(body, sys.exc_info())
+			except:
+				pass
+	
+	def __run(self):
+		delay = 0
+		while True:
+			try:
+				self.__serve()
+				return
+			except Exception:
+				self.__report(None)
+			# one more pass after close() so queued bodies still reach the disk, then give up
+			if self._terminated.is_set() and delay < 0:
+				return
+			delay = min(self.backoff_max, max(self.backoff_min, delay*2))
+			if self._terminated.wait(delay * random.uniform(0.5, 1.0)):
+				delay = -1
+	
+	def __serve(self):
+		metadata = FileMessageQueue.open_metadata(self.path)
+		consumer, tsd = None, HTTPConnection(*self.address, timeout=self.timeout, **self._options)
+		try:
+			producer = FileMessageQueue.Producer(self.queue_name, path=self.path, metadata=metadata)
+			message, delay, next_replay, backlog = None, 0, 0, True
+			while True:
+				# bodies stay in _pending until they are committed, so a restart does not lose them
+				if not self._pending:
+					try:
+						wait = 0 if backlog and time.time() >= next_replay else 0.1
+						self._pending.append(self._incoming.get(timeout=wait) if wait else self._incoming.get_nowait())
+					except queue.Empty:
+						if self._terminated.is_set():
+							break
+				while True:
+					try:
+						self._pending.append(self._incoming.get_nowait())
+					except queue.Empty:
+						break
+				if self._pending:
+					for body in self._pending:
+						producer.send(body)
+					producer.commit()
+					self.spooled += len(self._pending)
+					self._pending.clear()
+					backlog = True
+				
+				now = time.time()
+				if now < next_replay:
+					continue
+				if consumer is None:
+					try:
+						consumer = FileMessageQueue.Consumer(self.queue_name, 'tsdb', path=self.path, metadata=metadata)
+					except FileMessageQueue.Error:
+						# another spool of this process replays the directory, keep spooling only
+						self.__report(None)
+						next_replay = now + self.backoff_max
+						continue
+				if message is None:
+					message = consumer.poll()
+					if message is None:
+						backlog = False
+						continue
+				try:
+					reply = tsd.request('POST', '/api/put?details', message.payload)
+					if tsd.last_response['status'] >= 500:
+						raise http.client.HTTPException('%d %s'%(tsd.last_response['status'], tsd.last_response['reason']))
+				except:
+					tsd.close()
+					delay = min(self.backoff_max, max(self.backoff_min, delay*2))
+					next_replay = now + delay * random.uniform(0.5, 1.0)
+					continue
+				consumer.commit()
+				body, message, delay = message.payload, None, 0
+				self.replayed += 1
+				next_replay = now + 1.0/self.rate if self.rate else now
+				# outside the POST's try, a failing callback must not replay the body again
+				if callable(self._callback):
+					try:
+						self._callback(body, reply)
+					except Exception:
+						self.__report(body)
+		finally:
+			tsd.close()
+			consumer = None
+			metadata.close()
+
+
+class _Sketch:
+	# log-bucketed quantile sketch with relative accuracy `accuracy`
+	def __init__(self, accuracy=0.01):
+		self.gamma = math.log((1 + accuracy) / (1 - accuracy))
+		self.buckets, self.count = {}, 0
+	
+	def add(self, value):
+		if value:
+			key = (1 if value > 0 else -1, math.ceil(math.log(abs(value)) / self.gamma))
+		else:
+			key = (0, 0)
+		self.buckets[key] = self.buckets.get(key, 0) + 1
+		self.count += 1
+	
+	def __value(self, key):
+		sign, index = key
+		return sign * 2 * math.exp(index * self.gamma) / (1 + math.exp(self.gamma))
+	
+	def quantile(self, q):
+		rank, seen = q * (self.count - 1), 0
+		order = sorted(self.buckets, key=self.__value)
+		for key in order:
+			seen += self.buckets[key]
+			if seen > rank:
+				return self.__value(key)
+		return self.__value(order[-1])
+
+
+class Aggregator:
+	# rolls up raw points per (metric, tags, interval) and emits <metric>.<aggregate> at the interval start.
+	# Closed intervals go out from put_many() or flush(), TSDB(aggregate=...) calls flush() from a timer
+	AGGREGATES = ('sum', 'count', 'min', 'max', 'last')
+	
+	def __init__(self, emit, interval=60, aggregates=AGGREGATES, percentiles=(), accuracy=0.01):
+		# emit(metric, timestamps, values, tags), e.g. TSDB.put_many
+		assert(interval > 0 and set(aggregates).issubset(self.AGGREGATES))
+		self.emit, self.interval = emit, interval
+		self.aggregates, self.percentiles, self.accuracy = aggregates, percentiles, accuracy
+		# buckets are keyed by (series, interval start) so out-of-order points land in their own interval;
+		# points for an interval already emitted would overwrite the stored rollup and are dropped as late
+		self._buckets, self._emitted = {}, {}
+		self.late = 0
+		self._next_flush = (int(time.time())//interval + 1)*interval
+	
+	def __len__(self):
+		return len(self._buckets)
+	
+	def put(self, metric, timestamp, value, **kws):
+		self.put_many(metric, (timestamp,), (value,), kws)
+	
+	def put_many(self, metric, timestamps, values, tags):
+		_check_columns(timestamps, values)
+		series, interval, now = (metric, _series_tags(tags)), self.interval, time.time()
+		if timestamps is None:
+			timestamps = [now] * len(values)
+		emitted = self._emitted.get(series)
+		for timestamp, value in zip(timestamps, values):
+			start = int(timestamp or now)//interval*interval
+			if emitted is not None and start <= emitted:
+				self.late += 1
+				continue
+			bucket = self._buckets.get((series, start))
+			if bucket is None:
+				bucket = [start, 0, 0, value, value, value, _Sketch(self.accuracy) if self.percentiles else None]
+				self._buckets[(series, start)] = bucket
+			bucket[1] += value
+			bucket[2] += 1
+			if value < bucket[3]: bucket[3] = value
+			if value > bucket[4]: bucket[4] = value
+			bucket[5] = value
+			if bucket[6]: bucket[6].add(value)
+		if now >= self._next_flush:
+			self.flush()
+	
+	def flush(self, force=False):
+		now = time.time()
+		closed = sorted((key for key, bucket in self._buckets.items() if force or bucket[0] + self.interval <= now),
+		                key=lambda key: key[1])
+		for key in closed:
+			series, start = key
+			self.__emit(series, self._buckets.pop(key))
+			self._emitted[series] = max(start, self._emitted.get(series, start))
+		self._next_flush = (int(now)//self.interval + 1)*self.interval
+	
+	def __emit(self, key, bucket):
+		metric, tags = key
+		tags = dict(tags)
+		start, total, count, minimum, maximum, last, sketch = bucket
+		values = dict(sum=total, count=count, min=minimum, max=maximum, last=last)
+		for aggregate in self.aggregates:
+			self.emit('%s.%s'%(metric, aggregate), (start,), (values[aggregate],), tags)
+		for p in self.percentiles:
+			self.emit('%s.p%s'%(metric, p), (start,), (sketch.quantile(p/100.0),), tags)
+
+
+def _query_columns(status, reply):
+	if status != 200 or not isinstance(reply, list):
+		return _query_result(status, reply)
+	# OpenTSDB answers [] for a range without datapoints, that is an empty result and not an error
+	dps = sorted((int(timestamp), value) for timestamp, value in reply[0]['dps'].items()) if reply else []
+	return array.array('q', [t for t, _ in dps]), array.array('d', [v for _, v in dps])
+
+
+class QueryClient:
+	# /api/query with an LRU cache and parallel time-range splitting, results are (timestamps, values) arrays.
+	# Absolute ranges are cut on a `chunk`-second grid; chunks older than `settle` seconds are cached
+	# until evicted, the others for `ttl` seconds.
+	def __init__(self, host='localhost', port=4242, timeout=2.0, **kws):
+		self.host, self.port, self.timeout = host, port, timeout
+		self.chunk = kws.get('chunk', 86400)
+		self.ttl = kws.get('ttl', 10.0)
+		self.settle = kws.get('settle', 3600)
+		self.maxsize = kws.get('maxsize', 1024)
+		self.processes = kws.get('processes', 8)
+		self._pool = ConnectionPool(host, port, timeout, maxsize=self.processes)
+		self._options = {k:kws[k] for k in ('retries', 'backoff', 'gzip', 'gzip_min') if k in kws}
+		# `ttl` is the query cache's here, the metadata cache takes metadata_ttl
+		self._options.update(_cache_options(kws, ttl='metadata_ttl'))
+		self._workers = None
+		self._cache, self._lock = OrderedDict(), threading.Lock()
+		self.hits, self.misses = 0, 0
+	
+	def close(self):
+		if self._workers:
+			self._workers.close()
+			self._workers.join()
+			self._workers = None
+		self._pool.close()
+	
+	def clear(self):
+		with self._lock:
+			self._cache.clear()
+	
+	def __get(self, key):
+		with self._lock:
+			entry = self._cache.get(key)
+			if entry is None or (entry[0] is not None and entry[0] < time.time()):
+				self.misses += 1
+				return None
+			self._cache.move_to_end(key)
+			self.hits += 1
+			return entry[1]
+	
+	def __put(self, key, result, expires):
+		with self._lock:
+			self._cache[key] = (expires, result)
+			self._cache.move_to_end(key)
+			while len(self._cache) > self.maxsize:
+				self._cache.popitem(last=False)
+	
+	def __fetch(self, args):
+		tsd = HTTPConnection(self.host, self.port, self.timeout, pool=self._pool, **self._options)
+		try:
+			reply = tsd.request('POST', '/api/query', json.dumps(_query_data(*args)))
+			return _query_columns(tsd.last_response['status'] if reply is not None else None, reply)
+		finally:
+			tsd.close()
+	
+	def query(self, metric, start, end=None, tags={}, aggregator='avg', downsample=None):
+		now = int(time.time())
+		series = (metric, tuple(sorted(tags.items())), aggregator, downsample)
+		if not isinstance(start, (int, float)) or not isinstance(end, (int, float, type(None))):
+			# relative times like '1h-ago' are neither split nor cached beyond ttl
+			ranges = [(start, end)]
+		else:
+			start, end = int(start), int(end or now)
+			grid = start//self.chunk*self.chunk
+			ranges = [(max(t, start), min(t + self.chunk - 1, end)) for t in range(grid, end + 1, self.chunk)]
+		
+		results, missing = [None]*len(ranges), []
+		for i, r in enumerate(ranges):
+			results[i] = self.__get(series + r)
+			if results[i] is None:
+				missing.append(i)
+		if missing:
+			if len(missing) == 1:
+				fetched = [self.__fetch((metric,) + ranges[missing[0]] + (tags, aggregator, downsample))]
+			else:
+				if self._workers is None:
+					self._workers = ThreadPool(self.processes)
+				fetched = self._workers.map(self.__fetch, [(metric,) + ranges[i] + (tags, aggregator, downsample) for i in missing])
+			error = None
+			for i, result in zip(missing, fetched):
+				if not isinstance(result, tuple):
+					error = error or result
+					continue
+				results[i] = result
+				r_end = ranges[i][1]
+				closed = isinstance(r_end, int) and r_end < now - self.settle
+				self.__put(series + ranges[i], result, None if closed else time.time() + self.ttl)
+			if error is not None:
+				return error
+		
+		if len(results) == 1:
+			return results[0]
+		timestamps, values = array.array('q'), array.array('d')
+		for ts, vs in results:
+			timestamps.extend(ts)
+			values.extend(vs)
+		return timestamps, values
+
+
+class Stats:
+	# thread-safe counters and a latency histogram (seconds, cumulative upper bounds)
+	BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, math.inf)
+	
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.counters = {}
+		self.latency = [0] * len(self.BOUNDS)
+		self.latency_sum = 0.0
+	
+	def incr(self, name, n=1):
+		with self._lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+	
+	def observe(self, seconds):
+		with self._lock:
+			for i, bound in enumerate(self.BOUNDS):
+				if seconds <= bound:
+					self.latency[i] += 1
+					break
+			self.latency_sum += seconds
+	
+	def quantile(self, q):
+		count = sum(self.latency)
+		if not count: return 0.0
+		rank, seen = q * count, 0
+		for bound, n in zip(self.BOUNDS, self.latency):
+			seen += n
+			if seen >= rank:
+				return bound
+		return math.inf
+	
+	def snapshot(self):
+		with self._lock:
+			count = sum(self.latency)
+			return dict(self.counters,
+			            latency_count=count,
+			            latency_avg=self.latency_sum/count if count else 0.0,
+			            latency_p50=self.quantile(0.5),
+			            latency_p99=self.quantile(0.99),
+			            latency_buckets=dict(zip(self.BOUNDS, self.latency)))
+
+
 class TSDB:
 	from multiprocessing.dummy import Process, Queue, Event
 	
 	def __init__(self, host='localhost', port=4242, timeout=2.0, **kws):
 		self.host, self.port, self.timeout = host, port, timeout
 		self.metrics, self.metrics_length = [], 0
-		tsd = HTTPConnection(host, port, timeout)
+		tsd = HTTPConnection(host, port, timeout, **_cache_options(kws))
 		max_chunk = kws.get('max_chunk', 0)
+		try:
+			server_max_chunk = int(tsd.config['tsd.http.request.max_chunk'])
+		except:
+			# with a spool the server may be down at startup, fall back to the OpenTSDB default
+			if not kws.get('spool'): raise
+			server_max_chunk = max_chunk if max_chunk > 0 else 4096
+		finally:
+			tsd.close()
 		if max_chunk <= 0:
-			self.max_chunk = int(tsd.config['tsd.http.request.max_chunk'])
+			self.max_chunk = server_max_chunk
 		else:
-			self.max_chunk = min(max_chunk, int(tsd.config['tsd.http.request.max_chunk']))
-		tsd.close()
+			self.max_chunk = min(max_chunk, server_max_chunk)
 		
 		self._processes = kws.get('processes', os.cpu_count())
 		self._requests = self.Queue(kws.get('qsize', self._processes))
 		self._terminated = self.Event()
 		self._callback = kws.get('callback')
 		self._error_callback = kws.get('error_callback')
+		self._options = dict(retries=kws.get('retries', 2), backoff=kws.get('backoff', 0.1),
+		                     gzip=kws.get('gzip', True), gzip_min=kws.get('gzip_min', 1024), **_cache_options(kws))
+		self._pool = ConnectionPool(host, port, timeout, maxsize=self._processes)
+		self._spool = None
+		if kws.get('spool'):
+			self._spool = Spool(kws['spool'], host, port, timeout, **dict(kws, **self._options))
+		self.deadband = None
+		if kws.get('deadband') is not None:
+			self.deadband = Deadband(kws['deadband'], kws.get('heartbeat', 600), kws.get('relative', False))
+		self._aggregator = None
+		if kws.get('aggregate'):
+			self._aggregator = Aggregator(self.__put_many, kws['aggregate'],
+			                              kws.get('aggregates', Aggregator.AGGREGATES), kws.get('percentiles', ()))
+		self._stats = Stats()
+		self._stats_interval = kws.get('stats_interval', 0)
+		self._stats_prefix = kws.get('stats_prefix', 'tsdb.client')
+		self._stats_tags = kws.get('stats_tags') or dict(host=socket.gethostname())
+		# extra objects with snapshot() -> {name: value}, e.g. svipc.SharedCounters filled by worker processes
+		self._stats_sources = list(kws.get('stats_sources', ()))
+		# _lock guards the buffer against the rollup timer
+		self._lock = threading.RLock()
 		self._handlers = [self.__new_handler()]
+		# stats and closed rollups are emitted by timer threads, so an idle producer still reports
+		self._timers_stopped, self._timers = threading.Event(), []
+		if self._stats_interval:
+			self._timers.append(threading.Thread(target=TSDB.__stats_loop, daemon=True,
+			                                     args=(weakref.ref(self), self._timers_stopped, self._stats_interval)))
+		if self._aggregator is not None:
+			self._timers.append(threading.Thread(target=TSDB.__aggregate_loop, daemon=True,
+			                                     args=(weakref.ref(self), self._timers_stopped)))
+		for timer in self._timers:
+			timer.start()
 	
 	def __del__(self):
 		if self._handlers:
 			self.close()
 	
 	def close(self):
+		self._timers_stopped.set()
+		for timer in self._timers:
+			timer.join()
+		self._timers.clear()
+		if self._aggregator is not None:
+			self._aggregator.flush(force=True)
 		self.commit()
 		self._terminated.set()
 		for handler in self._handlers:
 			handler.join()
 		self._handlers.clear()
+		if self._spool:
+			self._spool.close()
+			self._spool = None
+		self._pool.close()
 		self._terminated.clear()
 	
 	def __len__(self):
 		return len(self.metrics)
 	
 	def put(self, metric, timestamp, value, **kws):
-		if not timestamp: timestamp = time.time()
-		tags = {k:v for k,v in kws.items() if v not in (None,'')}
-		datapoint = json.dumps(dict(metric=metric, timestamp=int(timestamp), value=value, tags=tags))
-		if len(datapoint)+self.metrics_length+2 > self.max_chunk:
-			self.commit()
-		
-		self.metrics.append(datapoint)
-		self.metrics_length += len(datapoint) + 2
+		return self.put_many(metric, (timestamp,), (value,), kws)
+	
+	def put_many(self, metric, timestamps, values, tags):
+		if self._aggregator is not None:
+			with self._lock:
+				self._aggregator.put_many(metric, timestamps, values, tags)
+				return (self.max_chunk - self.metrics_length)
+		return self.__put_many(metric, timestamps, values, tags)
+	
+	def __put_many(self, metric, timestamps, values, tags):
+		if self.deadband is not None:
+			timestamps, values = self.deadband.filter(metric, timestamps, values, tags)
+		return self._append(_encode_points(metric, timestamps, values, tags))
+	
+	def put_multi(self, series):
+		# series: iterable of (metric, timestamps, values, tags)
+		remain = None
+		for metric, timestamps, values, tags in series:
+			remain = self.put_many(metric, timestamps, values, tags)
+		return remain
+	
+	def _append(self, datapoints):
+		for datapoint in datapoints:
+			if len(datapoint)+self.metrics_length+2 > self.max_chunk:
+				self.commit()
+			
+			self.metrics.append(datapoint)
+			self.metrics_length += len(datapoint) + 2
+		self._stats.incr('points', len(datapoints))
 		return (self.max_chunk - self.metrics_length)
 	
+	def stats(self):
+		result = self._stats.snapshot()
+		result.update(queue_depth=self._requests.qsize(), handlers=len(self._handlers),
+		              buffered_points=len(self.metrics), buffered_bytes=self.metrics_length)
+		if self._spool:
+			result.update(spooled=self._spool.spooled, replayed=self._spool.replayed, spool_errors=self._spool.errors)
+		return result
+	
+	@staticmethod
+	def __aggregate_loop(ref, stopped):
+		# flush and send closed intervals at each boundary, not only when the next point arrives
+		while True:
+			self = ref()
+			if self is None: return
+			delay = self._aggregator._next_flush - time.time()
+			del self
+			if stopped.wait(max(delay, 0.05)):
+				return
+			self = ref()
+			if self is None: return
+			with self._lock:
+				if time.time() >= self._aggregator._next_flush:
+					self.commit()
+			del self
+	
+	@staticmethod
+	def __stats_loop(ref, stopped, interval):
+		while not stopped.wait(interval):
+			self = ref()
+			if self is None: return
+			try:
+				self.__emit_stats()
+			except Exception:
+				self._stats.incr('stats_errors')
+			del self
+	
+	def __emit_stats(self):
+		# posted as bodies of their own, bypassing the producer's buffer, deadband and aggregator,
+		# and counted as stats_points rather than points
+		now = time.time()
+		stats = self.stats()
+		del stats['latency_buckets']
+		for source in self._stats_sources:
+			stats.update(source.snapshot())
+		datapoints = []
+		for name, value in stats.items():
+			if value != math.inf:
+				datapoints.extend(_encode_points('%s.%s'%(self._stats_prefix, name), (now,), (value,), self._stats_tags))
+		self._stats.incr('stats_points', len(datapoints))
+		chunk, length = [], 0
+		for datapoint in datapoints:
+			if chunk and len(datapoint)+length+2 > self.max_chunk:
+				self.__submit('[' + ', '.join(chunk) + ']')
+				chunk, length = [], 0
+			chunk.append(datapoint)
+			length += len(datapoint) + 2
+		if chunk:
+			self.__submit('[' + ', '.join(chunk) + ']')
+	
 	def commit(self):
+		with self._lock:
+			self.__commit()
+	
+	def __commit(self):
+		if self._aggregator is not None:
+			self._aggregator.flush()
 		if not self.metrics: return
+		self._stats.incr('commits')
 		if self._requests.full() and len(self._handlers)<self._processes:
 			self._handlers.append(self.__new_handler())
-		self._requests.put('[' + ', '.join(self.metrics) + ']')
+		body = '[' + ', '.join(self.metrics) + ']'
 		self.metrics, self.metrics_length = [], 0
+		self.__submit(body)
+	
+	def __submit(self, body):
+		if self._spool:
+			try:
+				self._requests.put_nowait(body)
+			except queue.Full:
+				self._spool.put(body)
+		else:
+			self._requests.put(body)
 	
 	def __new_handler(self):
 		handler = self.Process(target=self.__handler, 
 		                       args=(self.host, self.port, self.timeout,
 		                             self._requests, self._terminated,
-		                             self._callback, self._error_callback))
+		                             self._callback, self._error_callback, self._spool,
+		                             dict(self._options, pool=self._pool), self._stats))
 		handler.start()
 		return handler
 	
 	@staticmethod
-	def __handler(host, port, timeout, requests, terminated, callback, error_callback):
-		tsd = HTTPConnection(host, port, timeout)
+	def __handler(host, port, timeout, requests, terminated, callback, error_callback, spool=None, options={}, stats=None):
+		tsd = HTTPConnection(host, port, timeout, **options)
+		stats = stats or Stats()
 		while True:
 			try:
 				request_body = requests.get(timeout=0.1)
+				begin = time.time()
+				stats.incr('posts')
+				stats.incr('bytes', len(request_body))
 				reply = tsd.request('POST', '/api/put?details', request_body)
+				stats.observe(time.time() - begin)
+				if tsd.last_response['status'] >= 500:
+					raise http.client.HTTPException('%d %s'%(tsd.last_response['status'], tsd.last_response['reason']))
+				if isinstance(reply, dict):
+					stats.incr('success', reply.get('success', 0))
+					stats.incr('failed', reply.get('failed', 0))
 				if callable(callback):
 					callback(request_body, reply)
 			
@@ -254,8 +1231,191 @@ class TSDB:
 					break
 			except:
 				tsd.close()
-				if callable(error_callback):
+				stats.incr('post_errors')
+				if spool:
+					spool.put(request_body)
+				elif callable(error_callback):
 					try:
 						error_callback(request_body, sys.exc_info())
 					except:
 						pass
+
+
+class AsyncTSDB:
+	# asyncio writer: bodies are queued up to max_pending and posted by max_inflight workers.
+	# put()/commit() wait for room in the queue, put_nowait()/commit_nowait() raise asyncio.QueueFull instead.
+	def __init__(self, host='localhost', port=4242, timeout=2.0, **kws):
+		self.host, self.port, self.timeout = host, port, timeout
+		self.metrics, self.metrics_length = [], 0
+		self.max_chunk = kws.get('max_chunk', 0)
+		self.max_inflight = kws.get('max_inflight', 4)
+		self.flush_interval = kws.get('flush_interval', 1.0)
+		self.retries = kws.get('retries', 2)
+		self.backoff = kws.get('backoff', 0.1)
+		self.gzip = kws.get('gzip', True)
+		self.gzip_min = kws.get('gzip_min', 1024)
+		self._bodies = asyncio.Queue(kws.get('max_pending', self.max_inflight*2))
+		self._callback = kws.get('callback')
+		self._error_callback = kws.get('error_callback')
+		self._idle, self._tasks = [], []
+		self._last_commit = time.time()
+	
+	async def start(self):
+		reply = await self.request('GET', '/api/config')
+		server_max_chunk = int(reply['tsd.http.request.max_chunk'])
+		self.max_chunk = min(self.max_chunk, server_max_chunk) if self.max_chunk > 0 else server_max_chunk
+		self._tasks = [asyncio.ensure_future(self.__sender()) for _ in range(self.max_inflight)]
+		self._tasks.append(asyncio.ensure_future(self.__flusher()))
+		return self
+	
+	async def close(self):
+		await self.commit()
+		await self._bodies.join()
+		for task in self._tasks:
+			task.cancel()
+		await asyncio.gather(*self._tasks, return_exceptions=True)
+		self._tasks.clear()
+		while self._idle:
+			reader, writer = self._idle.pop()
+			writer.close()
+	
+	async def __aenter__(self):
+		return await self.start()
+	
+	async def __aexit__(self, exc_type, exc_val, exc_tb):
+		await self.close()
+	
+	def __len__(self):
+		return len(self.metrics)
+	
+	@property
+	def pending(self):
+		return self._bodies.qsize()
+	
+	@property
+	def full(self):
+		return self._bodies.full()
+	
+	async def put(self, metric, timestamp, value, **kws):
+		return await self.put_many(metric, (timestamp,), (value,), kws)
+	
+	async def put_many(self, metric, timestamps, values, tags):
+		for datapoint in _encode_points(metric, timestamps, values, tags):
+			if len(datapoint)+self.metrics_length+2 > self.max_chunk:
+				await self.commit()
+			self.__append(datapoint)
+		return (self.max_chunk - self.metrics_length)
+	
+	def put_nowait(self, metric, timestamp, value, **kws):
+		for datapoint in _encode_points(metric, (timestamp,), (value,), kws):
+			if len(datapoint)+self.metrics_length+2 > self.max_chunk:
+				self.commit_nowait()
+			self.__append(datapoint)
+		return (self.max_chunk - self.metrics_length)
+	
+	def __append(self, datapoint):
+		self.metrics.append(datapoint)
+		self.metrics_length += len(datapoint) + 2
+	
+	def __body(self):
+		body = '[' + ', '.join(self.metrics) + ']'
+		self.metrics, self.metrics_length = [], 0
+		self._last_commit = time.time()
+		return body
+	
+	async def commit(self):
+		if not self.metrics: return
+		await self._bodies.put(self.__body())
+	
+	def commit_nowait(self):
+		if not self.metrics: return
+		if self._bodies.full():
+			raise asyncio.QueueFull('Too many pending requests')
+		self._bodies.put_nowait(self.__body())
+	
+	async def query(self, metric, start, end=None, tags={}, aggregator='avg', downsample=None):
+		query_data = _query_data(metric, start, end, tags, aggregator, downsample)
+		status, reply = await self._request('POST', '/api/query', json.dumps(query_data))
+		return _query_result(status, reply)
+	
+	async def request(self, method, url, body=None):
+		status, reply = await self._request(method, url, body)
+		return reply
+	
+	async def _request(self, method, url, body=None):
+		headers = "Host: {}:{}\r\nContent-Type: application/json;charset=UTF-8\r\n".format(self.host, self.port)
+		body = body.encode('utf-8') if isinstance(body, str) else (body or b'')
+		if body and self.gzip and len(body) >= self.gzip_min:
+			body = gzip.compress(body, compresslevel=1)
+			headers += "Content-Encoding: gzip\r\n"
+		head = "{} {} HTTP/1.1\r\n{}Content-Length: {}\r\n\r\n".format(method, url, headers, len(body)).encode('latin-1')
+		for retry in range(self.retries+1):
+			conn = None
+			try:
+				conn = self._idle.pop() if self._idle else \
+				       await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+				conn[1].write(head + body)
+				status, data, keep_alive = await asyncio.wait_for(self.__response(conn[0]), self.timeout)
+				if keep_alive:
+					self._idle.append(conn)
+				else:
+					conn[1].close()
+				return status, (json.loads(data.decode('utf-8')) if data else None)
+			except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError):
+				if conn: conn[1].close()
+				if retry >= self.retries:
+					raise
+				await asyncio.sleep(self.backoff * 2**retry * random.uniform(0.5, 1.5))
+	
+	@staticmethod
+	async def __response(reader):
+		status_line = await reader.readline()
+		if not status_line:
+			raise ConnectionResetError('Connection closed by peer')
+		version, status = status_line.split(None, 2)[:2]
+		headers = {}
+		while True:
+			line = await reader.readline()
+			if line in (b'\r\n', b'\n', b''): break
+			k, _, v = line.decode('latin-1').partition(':')
+			headers[k.strip().lower()] = v.strip()
+		if headers.get('transfer-encoding', '').lower() == 'chunked':
+			data = bytearray()
+			while True:
+				size = int((await reader.readline()).split(b';')[0], 16)
+				if size:
+					data += await reader.readexactly(size)
+				await reader.readline()
+				if not size: break
+		else:
+			data = await reader.readexactly(int(headers.get('content-length', 0)))
+		if headers.get('content-encoding') == 'gzip':
+			data = gzip.decompress(data)
+		keep_alive = headers.get('connection', '').lower() != 'close' and version != b'HTTP/1.0'
+		return int(status), bytes(data), keep_alive
+	
+	async def __sender(self):
+		while True:
+			body = await self._bodies.get()
+			try:
+				status, reply = await self._request('POST', '/api/put?details', body)
+				if status >= 500:
+					raise http.client.HTTPException('%d %s'%(status, reply))
+				if callable(self._callback):
+					self._callback(body, reply)
+			except asyncio.CancelledError:
+				raise
+			except:
+				if callable(self._error_callback):
+					try:
+						self._error_callback(body, sys.exc_info())
+					except:
+						pass
+			finally:
+				self._bodies.task_done()
+	
+	async def __flusher(self):
+		while True:
+			await asyncio.sleep(self.flush_interval)
+			if self.metrics and time.time() - self._last_commit >= self.flush_interval and not self._bodies.full():
+				self.commit_nowait()
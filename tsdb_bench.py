@@ -0,0 +1,95 @@
+import time, json, array, argparse
+import tsdb
+from tsdb_fake import FakeTSDB
+
+
+def _wait_points(fake, counter, n, timeout=60):
+	deadline = time.time() + timeout
+	while fake.counters[counter] < n and time.time() < deadline:
+		time.sleep(0.001)
+	return fake.counters[counter]
+
+def _result(name, n, elapsed, **kws):
+	return dict(kws, client=name, points=n, seconds=round(elapsed, 4),
+	            points_per_sec=round(n / elapsed) if elapsed else 0)
+
+def bench_connection(fake, n, batch, **kws):
+	fake.reset()
+	c = tsdb.Connection(port=fake.telnet_port, host='127.0.0.1', buffer_size=batch*64, **kws)
+	begin = time.time()
+	for i in range(n):
+		c.put('bench.telnet', 1500000000+i, i, host='h%d'%(i%16))
+	c.flush()
+	received = _wait_points(fake, 'telnet_points', n)
+	elapsed = time.time() - begin
+	c.close()
+	return _result('Connection', received, elapsed, batch=batch)
+
+def bench_http(fake, n, batch, columnar=False, **kws):
+	fake.reset()
+	h = tsdb.HTTPConnection('127.0.0.1', fake.http_port, auto_commit=True, **kws)
+	h.config
+	begin = time.time()
+	if columnar:
+		timestamps, values = array.array('q', range(1500000000, 1500000000+batch)), array.array('d', range(batch))
+		for i in range(0, n, batch):
+			# the last batch is trimmed so exactly n points are sent, spread over 16 series
+			count = min(batch, n - i)
+			h.put_many('bench.http', timestamps[:count], values[:count], {'host':'h%d'%((i//batch)%16)})
+	else:
+		for i in range(n):
+			h.put('bench.http', 1500000000+i, i, host='h%d'%(i%16))
+	h.commit()
+	elapsed = time.time() - begin
+	h.close()
+	return _result('HTTPConnection' + ('.put_many' if columnar else ''), fake.counters['points'], elapsed, batch=batch)
+
+def bench_tsdb(fake, n, processes, columnar=False, **kws):
+	fake.reset()
+	db = tsdb.TSDB('127.0.0.1', fake.http_port, processes=processes, **kws)
+	begin = time.time()
+	if columnar:
+		batch = 1000
+		timestamps, values = array.array('q', range(1500000000, 1500000000+batch)), array.array('d', range(batch))
+		for i in range(0, n, batch):
+			count = min(batch, n - i)
+			db.put_many('bench.tsdb', timestamps[:count], values[:count], {'host':'h%d'%((i//batch)%16)})
+	else:
+		for i in range(n):
+			db.put('bench.tsdb', 1500000000+i, i, host='h%d'%(i%16))
+	db.close()
+	elapsed = time.time() - begin
+	return _result('TSDB' + ('.put_many' if columnar else ''), fake.counters['points'], elapsed, processes=processes)
+
+def run(n=100000, batches=(1, 64, 1024), processes=(1, 2, 4), **kws):
+	results = []
+	with FakeTSDB(latency=kws.get('latency', 0.0), error_rate=kws.get('error_rate', 0.0),
+	              max_chunk=kws.get('max_chunk', 65536)) as fake:
+		for batch in batches:
+			results.append(bench_connection(fake, n, batch))
+		for batch in batches:
+			results.append(bench_http(fake, n, batch, columnar=True))
+		results.append(bench_http(fake, n, 0))
+		for p in processes:
+			results.append(bench_tsdb(fake, n, p))
+			results.append(bench_tsdb(fake, n, p, columnar=True))
+	return results
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Ingest benchmark for tsdb clients against a local fake OpenTSDB')
+	parser.add_argument('-n', type=int, default=100000, help='datapoints per run')
+	parser.add_argument('--batch', type=int, nargs='+', default=[1, 64, 1024])
+	parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+	parser.add_argument('--latency', type=float, default=0.0, help='injected server latency in seconds')
+	parser.add_argument('--error-rate', type=float, default=0.0)
+	parser.add_argument('--json', action='store_true', help='print results as json')
+	args = parser.parse_args()
+	
+	results = run(args.n, args.batch, args.processes, latency=args.latency, error_rate=args.error_rate)
+	if args.json:
+		print(json.dumps(results, indent=2))
+	else:
+		for r in results:
+			extra = ' '.join('%s=%s'%(k, r[k]) for k in ('batch', 'processes') if k in r)
+			print('%-24s %-14s %8d points %8.3fs %10d points/s'%(r['client'], extra, r['points'], r['seconds'], r['points_per_sec']))
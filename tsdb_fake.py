@@ -0,0 +1,258 @@
+import socketserver, http.server
+import time, re, json, gzip, random, threading
+
+
+class FakeTSDB:
+	# in-process stand-in for OpenTSDB: /api/config, /api/put, /api/query, /api/uid/assign, /api/suggest
+	# and the telnet put protocol, with injectable latency and error rate
+	def __init__(self, host='127.0.0.1', http_port=0, telnet_port=0, **kws):
+		self.latency = kws.get('latency', 0.0)
+		self.error_rate = kws.get('error_rate', 0.0)
+		self.max_chunk = kws.get('max_chunk', 65536)
+		self.lock = threading.Lock()
+		self.series = {}
+		self.uids = dict(metric={}, tagk={}, tagv={})
+		self.counters = dict(requests=0, errors=0, points=0, telnet_points=0, bytes=0)
+		
+		fake = self
+		class HTTPHandler(_HTTPHandler):
+			tsdb = fake
+		class TelnetHandler(_TelnetHandler):
+			tsdb = fake
+		self.http = http.server.ThreadingHTTPServer((host, http_port), HTTPHandler)
+		self.http.daemon_threads = True
+		self.telnet = socketserver.ThreadingTCPServer((host, telnet_port), TelnetHandler)
+		self.telnet.daemon_threads = True
+		self._threads = []
+	
+	@property
+	def http_port(self):
+		return self.http.server_address[1]
+	
+	@property
+	def telnet_port(self):
+		return self.telnet.server_address[1]
+	
+	def start(self):
+		for server in (self.http, self.telnet):
+			thread = threading.Thread(target=server.serve_forever, daemon=True)
+			thread.start()
+			self._threads.append(thread)
+		return self
+	
+	def close(self):
+		for server in (self.http, self.telnet):
+			server.shutdown()
+			server.server_close()
+		for thread in self._threads:
+			thread.join()
+		self._threads.clear()
+	
+	def __enter__(self):
+		return self.start()
+	
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.close()
+	
+	def reset(self):
+		with self.lock:
+			self.series.clear()
+			for counter in self.counters:
+				self.counters[counter] = 0
+	
+	def delay(self):
+		if self.latency:
+			time.sleep(self.latency)
+		if self.error_rate and random.random() < self.error_rate:
+			with self.lock:
+				self.counters['errors'] += 1
+			return True
+		return False
+	
+	def store(self, metric, timestamp, value, tags, counter='points'):
+		if not metric or not tags:
+			raise ValueError('Missing metric or tags')
+		timestamp, value = int(timestamp), float(value)
+		key = (metric, tuple(sorted(tags.items())))
+		with self.lock:
+			self.series.setdefault(key, {})[timestamp] = value
+			self.counters[counter] += 1
+	
+	def put(self, datapoints):
+		success, errors = 0, []
+		for dp in datapoints:
+			try:
+				self.store(dp['metric'], dp['timestamp'], dp['value'], dp['tags'])
+				success += 1
+			except (KeyError, TypeError, ValueError) as e:
+				errors.append(dict(datapoint=dp, error=str(e)))
+		return dict(success=success, failed=len(errors), errors=errors)
+	
+	def query(self, request):
+		now = int(time.time())
+		start = _parse_time(request['start'], now)
+		end = _parse_time(request.get('end') or now, now)
+		aggregators = dict(sum=sum, min=min, max=max, avg=lambda vs: sum(vs)/len(vs), count=len)
+		results = []
+		for q in request['queries']:
+			tags = q.get('tags') or {}
+			aggregate = aggregators.get(q.get('aggregator', 'avg'), aggregators['avg'])
+			groups = {}
+			with self.lock:
+				for (metric, series_tags), dps in self.series.items():
+					series_tags = dict(series_tags)
+					if metric != q['metric'] or \
+					   any(series_tags.get(k) != v and not (v == '*' and k in series_tags) for k, v in tags.items()):
+						continue
+					group = tuple((k, series_tags[k]) for k, v in sorted(tags.items()) if v == '*')
+					groups.setdefault(group, []).append((series_tags, {t:v for t, v in dps.items() if start <= t <= end}))
+			for group, members in groups.items():
+				common = dict(set.intersection(*[set(t.items()) for t, _ in members]))
+				timestamps = sorted(set(t for _, dps in members for t in dps))
+				dps = {str(t): aggregate([dps[t] for _, dps in members if t in dps]) for t in timestamps}
+				results.append(dict(metric=q['metric'], tags=common,
+				                    aggregateTags=sorted(set(k for t, _ in members for k in t) - set(common)), dps=dps))
+		return results
+	
+	def assign_uids(self, request):
+		reply = {}
+		with self.lock:
+			for kind in ('metric', 'tagk', 'tagv'):
+				names = request.get(kind) or []
+				if not names: continue
+				uids, assigned, errors = self.uids[kind], {}, {}
+				for name in names:
+					if name in uids:
+						errors[name] = 'Name already exists with UID: %s'%uids[name]
+					else:
+						uids[name] = assigned[name] = '%06X'%(len(uids)+1)
+				reply[kind] = assigned
+				if errors:
+					reply[kind+'_errors'] = errors
+		return reply
+	
+	def suggest(self, request):
+		kind, q, limit = request['type'], request.get('q') or '', request.get('max') or 25
+		with self.lock:
+			if kind == 'metrics':
+				names = set(metric for metric, _ in self.series)
+			else:
+				index = 0 if kind == 'tagk' else 1
+				names = set(tag[index] for _, tags in self.series for tag in tags)
+		return sorted(name for name in names if str(name).startswith(q))[:limit]
+
+
+def _parse_time(t, now):
+	if isinstance(t, (int, float)):
+		return int(t) // 1000 if t > 1e12 else int(t)
+	m = re.match(r'^(\d+)(ms|s|m|h|d|w|n|y)-ago$', str(t))
+	if not m:
+		return int(t)
+	units = dict(ms=0.001, s=1, m=60, h=3600, d=86400, w=604800, n=2592000, y=31536000)
+	return now - int(int(m.group(1)) * units[m.group(2)])
+
+
+class _HTTPHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	disable_nagle_algorithm = True
+	tsdb = None
+	
+	def log_message(self, format, *args):
+		pass
+	
+	def reply(self, status, obj):
+		body = json.dumps(obj).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json; charset=UTF-8')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+	
+	def error(self, status, message):
+		self.reply(status, {'error': {'code': status, 'message': message}})
+	
+	def do_GET(self):
+		tsdb = self.tsdb
+		with tsdb.lock:
+			tsdb.counters['requests'] += 1
+		if tsdb.delay():
+			return self.error(500, 'Injected error')
+		if self.path.startswith('/api/config'):
+			return self.reply(200, {'tsd.http.request.max_chunk': str(tsdb.max_chunk),
+			                        'tsd.http.request.enable_chunked': 'true'})
+		if self.path.startswith('/api/version'):
+			return self.reply(200, {'version': 'fake'})
+		self.error(404, 'Endpoint not found')
+	
+	def do_POST(self):
+		tsdb = self.tsdb
+		body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+		with tsdb.lock:
+			tsdb.counters['requests'] += 1
+			tsdb.counters['bytes'] += len(body)
+		if tsdb.delay():
+			return self.error(500, 'Injected error')
+		if len(body) > tsdb.max_chunk:
+			return self.error(413, 'Chunked request body exceeds max_chunk')
+		try:
+			if self.headers.get('Content-Encoding') == 'gzip':
+				body = gzip.decompress(body)
+			request = json.loads(body.decode('utf-8')) if body else {}
+		except ValueError as e:
+			return self.error(400, 'Unable to parse the given JSON: %s'%e)
+		
+		path = self.path.split('?')[0]
+		if path == '/api/put':
+			reply = tsdb.put(request if isinstance(request, list) else [request])
+			status = 400 if reply['failed'] else (200 if 'details' in self.path else 204)
+			if status == 204:
+				self.send_response(204)
+				self.send_header('Content-Length', '0')
+				return self.end_headers()
+			return self.reply(status, reply)
+		if path == '/api/query':
+			return self.reply(200, tsdb.query(request))
+		if path == '/api/uid/assign':
+			reply = tsdb.assign_uids(request)
+			return self.reply(400 if any(k.endswith('_errors') for k in reply) else 200, reply)
+		if path == '/api/suggest':
+			return self.reply(200, tsdb.suggest(request))
+		if path == '/api/annotation':
+			return self.reply(200, request)
+		self.error(404, 'Endpoint not found')
+
+
+class _TelnetHandler(socketserver.StreamRequestHandler):
+	disable_nagle_algorithm = True
+	tsdb = None
+	
+	def handle(self):
+		tsdb = self.tsdb
+		for line in self.rfile:
+			words = line.decode('latin-1').split()
+			if not words: continue
+			if words[0] == 'version':
+				self.wfile.write(b'net.opentsdb fake\n')
+				continue
+			if words[0] != 'put':
+				self.wfile.write(('unknown command: %s\n'%words[0]).encode('latin-1'))
+				continue
+			if tsdb.delay():
+				self.wfile.write(b'put: injected error\n')
+				continue
+			try:
+				if len(words) < 5:
+					raise ValueError('not enough arguments (need least 4, got %d)'%(len(words)-1))
+				tags = dict(word.split('=', 1) for word in words[4:])
+				tsdb.store(words[1], words[2], words[3], tags, counter='telnet_points')
+			except ValueError as e:
+				self.wfile.write(('put: illegal argument: %s\n'%e).encode('latin-1'))
+
+
+if __name__ == "__main__":
+	import sys
+	http_port, telnet_port = (int(sys.argv[1]), int(sys.argv[2])) if len(sys.argv) > 2 else (4242, 4243)
+	with FakeTSDB('0.0.0.0', http_port, telnet_port) as fake:
+		print('fake OpenTSDB: http on %d, telnet on %d'%(fake.http_port, fake.telnet_port))
+		while True:
+			time.sleep(60)